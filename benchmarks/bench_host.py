@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""Benchmarks for the host side of the RPC stack.
+
+No hardware is needed: round-trips are measured against the simulated device.
+
+Run the whole suite and store the results:
+    python benchmarks/bench_host.py -o results.json
+
+Compare against the results of another commit:
+    python benchmarks/bench_host.py -o new.json --compare results.json
+"""
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from targettest.cbor import CBORPayload
+from targettest.codec import CodecRegistry, record
+from targettest.log_buffer import LogBuffer
+from targettest.rpc_channel import RPCChannel
+from targettest.rpc_packet import RPCPacket, RPCPacketType
+from targettest.sim import RPCPeer, LoopbackTransport, SimulatedDevkit
+from targettest.uart_channel import UARTRPCChannel
+
+# Realistic payloads, see tests/bt_notify
+SCAN_REPORT = [[1, bytes.fromhex('c00000000001')], 0, 3, -40]
+NESTED_LIST = [[1337, -1234], [b'hello\x00', -1, b'from the other\x00', 2, 3, b'side\x00']]
+CONN_PARAMS = [[1, bytes.fromhex('c00000000002')], [0, 60, 30, 2000]]
+LARGE_LIST = list(range(-500, 500, 3))
+
+BENCHMARKS = {}
+
+def benchmark(name, unit):
+    """Register a benchmark. It returns a (count, elapsed_s) tuple, reported in `unit`/s.
+
+    A dict of other metrics can follow, they are stored in the results as-is.
+    """
+    def register(fn):
+        BENCHMARKS[name] = (fn, unit)
+        return fn
+    return register
+
+
+def measure(fn, min_time=0.2):
+    """Call fn() until min_time has elapsed. Returns (count, elapsed)."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time:
+            return (count, elapsed)
+
+
+def make_stream(packet_count=2000, noise=False, seed=0):
+    rng = random.Random(seed)
+    frames = []
+    for i in range(packet_count):
+        if noise and i % 4 == 0:
+            # Garbage, including partial magic values
+            frames.append(rng.choice([b'U', b'UA', b'UAR', b'\x00\xff']) +
+                          bytes(rng.randrange(256) for _ in range(rng.randrange(16))))
+        payload = CBORPayload(SCAN_REPORT).encoded
+        frames.append(RPCPacket(RPCPacketType.EVT, 4, 0, 0xFF, 0, 0, payload).raw)
+
+    return (b''.join(frames), packet_count)
+
+
+class Decoder():
+    """UARTRPCChannel that isn't opened, only its decoding path is used."""
+    def __init__(self):
+        (self._main, self._sub) = pty.openpty()
+        tty.setraw(self._sub)
+        self.count = 0
+        self.channel = UARTRPCChannel(port=os.ttyname(self._sub), rtscts=False)
+        self.channel.packet_handler = self._handler
+
+    def _handler(self, packet):
+        self.count += 1
+
+    def close(self):
+        self.channel.uart._serial.close()
+        os.close(self._main)
+        os.close(self._sub)
+
+
+def bench_decode(chunk_size, noise=False):
+    (stream, packet_count) = make_stream(noise=noise)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    decoder = Decoder()
+
+    def run():
+        for chunk in chunks:
+            decoder.channel.handle_rx(chunk)
+
+    try:
+        (count, elapsed) = measure(run)
+        assert decoder.count == count * packet_count, 'Packets lost while decoding'
+    finally:
+        decoder.close()
+
+    return (count * len(stream), elapsed)
+
+for chunk_size in (1, 7, 64, 256, 4096):
+    benchmark(f'decode_clean_chunk{chunk_size}', 'B')(
+        lambda chunk_size=chunk_size: bench_decode(chunk_size))
+
+benchmark('decode_noisy_chunk256', 'B')(lambda: bench_decode(256, noise=True))
+
+
+@benchmark('rpc_packet_pack', 'packet')
+def bench_rpc_packet_pack():
+    payload = CBORPayload(SCAN_REPORT).encoded
+    return measure(lambda: RPCPacket(RPCPacketType.EVT, 4, 0, 0xFF, 0, 0, payload).raw)
+
+@benchmark('rpc_packet_unpack', 'packet')
+def bench_rpc_packet_unpack():
+    raw = RPCPacket(RPCPacketType.EVT, 4, 0, 0xFF, 0, 0, CBORPayload(SCAN_REPORT).encoded).raw
+    return measure(lambda: RPCPacket.unpack(raw))
+
+
+def bench_cbor_encode(obj):
+    return measure(lambda: CBORPayload(obj).encoded)
+
+def bench_cbor_decode(obj):
+    encoded = CBORPayload(obj).encoded
+    return measure(lambda: CBORPayload.read(encoded).objects[0])
+
+for (name, obj) in (('scan_report', SCAN_REPORT),
+                    ('nested_list', NESTED_LIST),
+                    ('conn_params', CONN_PARAMS),
+                    ('large_list', LARGE_LIST)):
+    benchmark(f'cbor_encode_{name}', 'payload')(lambda obj=obj: bench_cbor_encode(obj))
+    benchmark(f'cbor_decode_{name}', 'payload')(lambda obj=obj: bench_cbor_decode(obj))
+
+
+@benchmark('cbor_encode_append_100', 'payload')
+def bench_cbor_append():
+    def run():
+        payload = CBORPayload()
+        for i in range(100):
+            payload.append(i)
+        return payload.encoded
+    return measure(run)
+
+@benchmark('cbor_encode_extend_1000', 'payload')
+def bench_cbor_extend():
+    def run():
+        payload = CBORPayload()
+        payload.extend(range(1000))
+        return payload.encoded
+    return measure(run)
+
+
+# Same layouts as in tests/bt_notify
+BtAddr = record('BtAddr', ('type', int), ('val', bytes))
+ScanReport = record('ScanReport', ('addr', BtAddr), ('adv_type', int), ('ad_len', int), ('rssi', int))
+ConnParams = record('ConnParams', ('options', int), ('interval', int), ('window', int), ('timeout', int))
+Connect = record('Connect', ('addr', BtAddr), ('params', ConnParams))
+
+CODECS = CodecRegistry()
+CODECS.register(1, ScanReport)
+CODECS.register(2, Connect)
+CODECS.register(3, Connect, memoize=True)
+
+def versus_generic(fn, generic):
+    """Measure fn(), and fail if it is slower than generic()."""
+    (count, elapsed) = measure(fn)
+    (generic_count, generic_elapsed) = measure(generic)
+
+    assert elapsed / count <= generic_elapsed / generic_count, \
+        (f'slower than generic CBOR: {elapsed / count * 1e6:.2f} us vs '
+         f'{generic_elapsed / generic_count * 1e6:.2f} us')
+
+    return (count, elapsed)
+
+@benchmark('codec_decode_scan_report', 'payload')
+def bench_codec_decode():
+    encoded = CBORPayload(SCAN_REPORT).encoded
+    return versus_generic(lambda: CODECS.decode(1, encoded),
+                          lambda: CBORPayload.read(encoded).objects[0])
+
+@benchmark('codec_encode_conn_params', 'payload')
+def bench_codec_encode():
+    return versus_generic(lambda: CODECS.encode(2, CONN_PARAMS),
+                          lambda: CBORPayload(CONN_PARAMS).encoded)
+
+@benchmark('codec_encode_conn_params_memoized', 'payload')
+def bench_codec_encode_memoized():
+    return versus_generic(lambda: CODECS.encode(3, CONN_PARAMS),
+                          lambda: CBORPayload(CONN_PARAMS).encoded)
+
+
+# A chatty device: short log lines, e.g. LOG_HEXDUMP_DBG output
+LOG_LINE = '[00:00:01.234,567] <dbg> nrf_rpc_uart: packet\n'
+
+@benchmark('log_buffer_append', 'B')
+def bench_log_buffer_append():
+    def run():
+        logs = LogBuffer()
+        for _ in range(10000):
+            logs.append(LOG_LINE)
+        return logs
+
+    (count, elapsed) = measure(run)
+    return (count * 10000 * len(LOG_LINE), elapsed)
+
+@benchmark('log_wait_for_since_marker', 'call')
+def bench_log_wait_for():
+    # Long run: only the lines after the marker are searched
+    logs = LogBuffer()
+    for _ in range(100000):
+        logs.append(LOG_LINE)
+    marker = logs.mark()
+    logs.append('[00:00:02.000,000] <inf> bt_notify: connected\n')
+
+    return measure(lambda: logs.wait_for(r'<inf> .*: connected', since=marker))
+
+
+def open_channel(transport, peer):
+    channel = RPCChannel(transport, group_name='nrf_pytest')
+    peer.register_evt(0x10, lambda peer, packet: None)
+    peer.register_cmd(0x11, lambda peer, packet: 0)
+
+    transport.open()
+    peer.open()
+    peer.reset()
+
+    end_time = time.monotonic() + 5
+    while not channel.established:
+        time.sleep(.001)
+        assert time.monotonic() < end_time, 'Simulated device unresponsive'
+
+    return channel
+
+def bench_round_trip(channel, call):
+    if call == 'evt':
+        return measure(lambda: channel.evt(0x10), min_time=1)
+    else:
+        return measure(lambda: channel.cmd(0x11), min_time=1)
+
+def bench_loopback(call):
+    transport = LoopbackTransport()
+    peer = RPCPeer(transport.remote_fd)
+    channel = open_channel(transport, peer)
+    try:
+        return bench_round_trip(channel, call)
+    finally:
+        peer.close()
+        transport.close()
+
+def bench_pty(call):
+    devkit = SimulatedDevkit(0, 'NRF53', 'bench')
+    transport = UARTRPCChannel(port=devkit.port, rtscts=False)
+    channel = open_channel(transport, devkit.peer)
+    try:
+        return bench_round_trip(channel, call)
+    finally:
+        transport.close()
+        devkit.close()
+
+def bench_rx_mode(rx_mode, idle_time=1):
+    """Round-trips over a pty with the given RX mode, and the CPU used by the
+    process while the link is idle."""
+    devkit = SimulatedDevkit(0, 'NRF53', 'bench')
+    transport = UARTRPCChannel(port=devkit.port, rtscts=False, rx_mode=rx_mode)
+    channel = open_channel(transport, devkit.peer)
+    try:
+        wakeups = transport.uart.rx_wakeups
+        start = time.process_time()
+        time.sleep(idle_time)
+        idle_cpu = time.process_time() - start
+        wakeups = transport.uart.rx_wakeups - wakeups
+
+        (count, elapsed) = bench_round_trip(channel, 'evt')
+        return (count, elapsed, {'idle_cpu_ms_per_s': idle_cpu / idle_time * 1e3,
+                                 'idle_rx_wakeups_per_s': wakeups / idle_time})
+    finally:
+        transport.close()
+        devkit.close()
+
+for rx_mode in ('event', 'poll'):
+    benchmark(f'rx_mode_{rx_mode}_evt_round_trip_pty', 'call')(
+        lambda rx_mode=rx_mode: bench_rx_mode(rx_mode))
+
+class LossyPeer(RPCPeer):
+    """Drops its next response, like a frame that fails the CRC check."""
+    def __init__(self, fd):
+        super().__init__(fd)
+        self.drop = None
+
+    def send(self, packet: RPCPacket):
+        if packet.packet_type == self.drop:
+            self.drop = None
+            return
+
+        super().send(packet)
+
+def bench_after_loss(call):
+    # The requests following a lost response must not time out
+    transport = LoopbackTransport()
+    peer = LossyPeer(transport.remote_fd)
+    channel = open_channel(transport, peer)
+    try:
+        if call == 'evt':
+            peer.drop = RPCPacketType.ACK
+            lost = lambda: channel.evt(0x10, timeout=.1)
+        else:
+            peer.drop = RPCPacketType.RSP
+            lost = lambda: channel.cmd(0x11, timeout=.1)
+
+        try:
+            lost()
+            raise AssertionError('The response was not dropped')
+        except Exception as e:
+            if 'timeout' not in str(e):
+                raise
+
+        return bench_round_trip(channel, call)
+    finally:
+        peer.close()
+        transport.close()
+
+for call in ('evt', 'cmd'):
+    benchmark(f'rpc_{call}_round_trip_loopback', 'call')(lambda call=call: bench_loopback(call))
+    benchmark(f'rpc_{call}_round_trip_pty', 'call')(lambda call=call: bench_pty(call))
+    benchmark(f'rpc_{call}_round_trip_after_loss', 'call')(lambda call=call: bench_after_loss(call))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(names):
+    results = {}
+    for name in names:
+        (fn, unit) = BENCHMARKS[name]
+        (count, elapsed, *metrics) = fn()
+        metrics = metrics[0] if metrics else {}
+        results[name] = {
+            'unit': f'{unit}/s',
+            'rate': count / elapsed,
+            'time_per_unit_us': elapsed / count * 1e6,
+            **metrics,
+        }
+        print(f'{name:40} {count / elapsed:14.1f} {unit}/s '
+              f'{elapsed / count * 1e6:12.2f} us/{unit}'
+              + ''.join(f' {key} {value:.1f}' for (key, value) in metrics.items()))
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+        },
+        'results': results,
+    }
+
+def compare(old, new, threshold):
+    """Print the relative change of each benchmark. Returns the regressed ones."""
+    regressions = []
+    print(f'\nComparison with {old["meta"].get("revision")} (threshold {threshold:.0%}):')
+    for (name, result) in new['results'].items():
+        if name not in old['results']:
+            continue
+
+        change = result['rate'] / old['results'][name]['rate'] - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+
+        print(f'{name:40} {change:+8.1%}{"  REGRESSION" if regressed else ""}')
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run the benchmarks containing this string')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression (default: 0.1)')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names)
+
+    if args.output is not None:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as stream:
+            old = json.load(stream)
+
+        if compare(old, results, args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,19 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
 #
+import time
+import pathlib
 import pytest
 import yaml
 import logging
 from contextlib import ExitStack
-from targettest.devkit import Devkit, discover_dks, halt_unused
+from targettest.log_archive import LogArchive
+from targettest.inventory import Inventory
+from targettest.flash_state import FlashState
+from targettest.devkit import Devkit, discover_dks, halt_unused, SESSIONS
 from targettest.provision import (register_dk, get_dk_list,
-                                  FlashedDevice, RPCDevice, TestDevice)
+                                  FlashedDevices, RPCDevice, TestDevice,
+                                  SimulatedDevice, load_sim_firmware)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,6 +24,12 @@ def pytest_addoption(parser):
     parser.addoption("--no-flash", action="store_true",
                      help='Skip the erase/flash cycle')
 
+    parser.addoption("--force-flash", action="store_true",
+                     help='Flash the devices even if they already have the firmware')
+
+    parser.addoption("--diff-flash", action="store_true",
+                     help='Only flash the pages that changed since the last run')
+
     # Note: has to be called with `-s` option so the test session can prompt the
     # user to reset the device(s) manually.
     parser.addoption("--no-emu", action="store_true",
@@ -33,20 +45,58 @@ This allows the use of a debugger during the test run.')
     parser.addoption("--tester-family", action="store",
                      help='specify a device (nrf52, nrf53) family for the Tester.')
 
+    parser.addoption("--sim", action="store_true",
+                     help='Run against simulated devices (the suite\'s fw/sim.py) instead of \
+hardware.')
+
+    parser.addoption("--rediscover", action="store_true",
+                     help='Probe all the devices, instead of using the cached inventory')
+
+    parser.addoption("--log-dir", action="store",
+                     help='Where to archive the device logs, defaults to build/logs/<date>')
+
 
 @pytest.fixture(scope="session", autouse=True)
 def devkits(request):
     # Don't discover devices if devconf was specified on cli
     devconf = request.config.getoption("--devconf")
     if devconf is not None:
+        yield
+        SESSIONS.close()
+        return
+
+    # Nor if no hardware is used
+    if request.config.getoption("--sim"):
+        yield
         return
 
     LOGGER.info(f'Discovering devices...')
-    devkits = discover_dks()
+    # Devices found by the previous runs, only the new or moved ones are probed
+    inventory = Inventory(pathlib.Path(request.config.rootdir) / 'build' / 'inventory.json',
+                          ttl=0 if request.config.getoption("--rediscover") else Inventory.TTL)
+    devkits = discover_dks(inventory)
     LOGGER.info(f'Available devices: {[devkit.segger_id for devkit in devkits]}')
     for devkit in devkits:
         register_dk(devkit)
 
+    yield
+
+    # The J-Link sessions are shared by all the tests
+    SESSIONS.close()
+
+@pytest.fixture(scope="session")
+def log_archive(request):
+    log_dir = request.config.getoption("--log-dir")
+    if log_dir is None:
+        log_dir = (pathlib.Path(request.config.rootdir) / 'build' / 'logs' /
+                   time.strftime('%Y%m%d-%H%M%S'))
+
+    archive = LogArchive(log_dir)
+
+    yield archive
+
+    archive.close()
+
 def get_device_by_name(devices, name):
     for dev in devices:
         if dev['name'] == name:
@@ -68,6 +118,12 @@ def flasheddevices(request):
     dut_family = request.config.getoption("--dut-family")
     tester_family = request.config.getoption("--tester-family")
 
+    # Firmware last flashed on each device, to skip flashing it again
+    flash_state = None
+    if not request.config.getoption("--force-flash"):
+        flash_state = FlashState(pathlib.Path(request.config.rootdir) / 'build' / 'flash_state',
+                                 differential=request.config.getoption("--diff-flash"))
+
     # Select the devices families
     if dut_family is None:
         dut_family = 'nrf53'
@@ -75,6 +131,22 @@ def flasheddevices(request):
     if tester_family is None:
         tester_family = 'nrf53'
 
+    if request.config.getoption("--sim"):
+        LOGGER.info('Using simulated devices')
+        with ExitStack() as stack:
+            dut_dk = stack.enter_context(
+                SimulatedDevice(request, name='DUT', family=dut_family))
+
+            tester_dk = stack.enter_context(
+                SimulatedDevice(request, name='Tester', family=tester_family))
+
+            devices = {'dut_dk': dut_dk, 'tester_dk': tester_dk}
+            load_sim_firmware(request, devices)
+
+            yield devices
+
+        return
+
     # Select the actual devices
     dut_id = None
     tester_id = None
@@ -101,25 +173,20 @@ def flasheddevices(request):
 
         LOGGER.info(f'DUT: {dut_id} Tester: {tester_id}')
 
-    # ExitStack is equivalent to multiple nested `with` statements, but is more readable
-    with ExitStack() as stack:
-        dut_dk = stack.enter_context(
-            FlashedDevice(request,
-                          name='DUT',
-                          family=dut_family,
-                          id=dut_id,
-                          board=get_board_by_family(dut_family),
-                          flash_device=flash,
-                          emu=emu))
-
-        tester_dk = stack.enter_context(
-            FlashedDevice(request,
-                          name='Tester',
-                          family=tester_family,
-                          id=tester_id,
-                          board=get_board_by_family(tester_family),
-                          flash_device=flash,
-                          emu=emu))
+    configs = [{'name': 'DUT',
+                'family': dut_family,
+                'id': dut_id,
+                'board': get_board_by_family(dut_family)},
+               {'name': 'Tester',
+                'family': tester_family,
+                'id': tester_id,
+                'board': get_board_by_family(tester_family)}]
+
+    # Both devices are flashed at the same time
+    with FlashedDevices(request, configs,
+                        flash_device=flash,
+                        emu=emu,
+                        flash_state=flash_state) as (dut_dk, tester_dk):
 
         devices = {'dut_dk': dut_dk, 'tester_dk': tester_dk}
         halt_unused(get_dk_list())
@@ -129,27 +196,31 @@ def flasheddevices(request):
         LOGGER.debug('closing DK APIs')
 
 @pytest.fixture()
-def testdevices(flasheddevices):
+def testdevices(request, flasheddevices, log_archive):
+    # Payload schemas of the test suite's opcodes, see targettest/codec.py
+    codecs = getattr(request.module, 'CODECS', None)
+
     with ExitStack() as stack:
-        try:
-            dut_dk = flasheddevices['dut_dk']
-            tester_dk = flasheddevices['tester_dk']
+        dut_dk = flasheddevices['dut_dk']
+        tester_dk = flasheddevices['tester_dk']
 
-            LOGGER.debug(f'opening DUT rpc {dut_dk.segger_id}')
-            dut_rpc = stack.enter_context(RPCDevice(dut_dk))
-            dut = TestDevice(dut_dk, dut_rpc)
+        # Closed last: the logs are archived until the RPC channels are closed,
+        # then a reference and the last lines are added to the report
+        dut_logs = stack.enter_context(log_archive.segment(request, dut_dk))
+        tester_logs = stack.enter_context(log_archive.segment(request, tester_dk))
 
-            LOGGER.debug(f'opening Tester rpc {tester_dk.segger_id}')
-            tester_rpc = stack.enter_context(RPCDevice(tester_dk))
-            tester = TestDevice(tester_dk, tester_rpc)
+        LOGGER.debug(f'opening DUT rpc {dut_dk.segger_id}')
+        dut_rpc = stack.enter_context(RPCDevice(dut_dk, codecs=codecs, trace=dut_logs.trace))
+        dut = TestDevice(dut_dk, dut_rpc)
 
-            devices = {'dut': dut, 'tester': tester}
-            LOGGER.info(f'Test devices: {devices}')
+        LOGGER.debug(f'opening Tester rpc {tester_dk.segger_id}')
+        tester_rpc = stack.enter_context(RPCDevice(tester_dk, codecs=codecs,
+                                                   trace=tester_logs.trace))
+        tester = TestDevice(tester_dk, tester_rpc)
 
-            yield devices
+        devices = {'dut': dut, 'tester': tester}
+        LOGGER.info(f'Test devices: {devices}')
 
-        finally:
-            LOGGER.info(f'[{dut_dk.segger_id}] DUT logs:\n{dut_dk.log}')
-            LOGGER.info(f'[{tester_dk.segger_id}] Tester logs:\n{tester_dk.log}')
+        yield devices
 
-            LOGGER.debug('closing RPC channels')
+        LOGGER.debug('closing RPC channels')
@@ -31,14 +31,46 @@ extern "C" {
  */
 extern const struct nrf_rpc_tr_api nrf_rpc_uart_api;
 
+/* Set in the length field of the frames carrying a fragment */
+#define NRF_RPC_UART_FRAGMENT_FLAG 0x8000
+#define NRF_RPC_UART_MAX_LEN 0x7FFF
+
 /* We have to use an additional header because the nRF RPC header
  * does not encode packet length information.
  */
 struct nrf_rpc_uart_header {
 	char start[4];		/* spells U A R T */
 	uint16_t len;
-	uint8_t crc;		/* CRC of whole frame */
+	uint8_t crc;		/* CRC of the length field and packet data */
 	uint8_t idx;		/* Current index, used when building header */
+	bool fragment;		/* The frame carries a fragment */
+};
+
+enum nrf_rpc_uart_frag_kind {
+	NRF_RPC_UART_FRAG_DATA = 0,
+	NRF_RPC_UART_FRAG_CREDIT = 1,
+};
+
+/* Starts the data of the frames carrying a fragment. Packets longer than
+ * CONFIG_NRF_RPC_UART_BUF_SIZE are split in fragments of
+ * CONFIG_NRF_RPC_UART_FRAG_SIZE bytes. The sender only has
+ * CONFIG_NRF_RPC_UART_FRAG_WINDOW fragments in flight, the receiver gives
+ * one credit back for each fragment it has consumed.
+ */
+struct nrf_rpc_uart_frag_header {
+	uint8_t kind;		/* enum nrf_rpc_uart_frag_kind */
+	uint8_t msg_id;
+	uint16_t index;
+	uint32_t value;		/* DATA: total packet length, CREDIT: credit count */
+} __packed;
+
+/* Packet being reassembled */
+struct nrf_rpc_uart_reassembly {
+	uint8_t *buf;
+	uint32_t len;
+	uint32_t total;
+	uint16_t index;
+	uint8_t msg_id;
 };
 
 /** @brief nRF RPC UART Service transport instance. */
@@ -62,6 +94,22 @@ struct nrf_rpc_uart {
 	/* packet buffer: stores only the packet to be sent to nRF RPC */
 	char *packet;
 
+	/** Number of packets dropped because of a CRC mismatch. */
+	uint32_t crc_errors;
+
+	/* Serializes the frames sent from different threads */
+	struct k_mutex tx_lock;
+
+	/* Only one fragmented packet is sent at a time */
+	struct k_mutex frag_lock;
+
+	/* Fragments the host can receive */
+	struct k_sem tx_credits;
+
+	uint8_t tx_msg_id;
+
+	struct nrf_rpc_uart_reassembly rx_frag;
+
 	/* Dispatches callbacks into nRF RPC */
 	struct k_work work;
 
@@ -13,6 +13,7 @@
 #include <zephyr/device.h>
 #include <zephyr/drivers/uart.h>
 #include <zephyr/sys/ring_buffer.h>
+#include <zephyr/sys/crc.h>
 
 #include <zephyr/sys/__assert.h>
 #include <zephyr/logging/log.h>
@@ -37,6 +38,148 @@ static inline void cleanup_state(struct nrf_rpc_uart *config)
 
 static void process_ringbuf(struct nrf_rpc_uart *uart_config);
 
+/* The CRC covers the length field, as sent, and the packet data. crc8_ccitt()
+ * is table-driven, which keeps it cheap enough to run on every packet.
+ */
+static uint8_t compute_crc(uint16_t len_field, const uint8_t *data, size_t len)
+{
+	uint8_t len_le[2] = {0xFF & len_field, 0xFF & (len_field >> 8)};
+	uint8_t crc = crc8_ccitt(CRC8_CCITT_INITIAL_VALUE, len_le, sizeof(len_le));
+
+	return crc8_ccitt(crc, data, len);
+}
+
+static uint16_t header_len_field(struct nrf_rpc_uart_header *header)
+{
+	return header->len | (header->fragment ? NRF_RPC_UART_FRAGMENT_FLAG : 0);
+}
+
+static void send_frame(struct nrf_rpc_uart *uart_config, uint16_t len_field,
+		       const struct nrf_rpc_uart_frag_header *frag,
+		       const uint8_t *data, size_t length)
+{
+	size_t frag_len = frag ? sizeof(*frag) : 0;
+	uint8_t crc = compute_crc(len_field, (const uint8_t *)frag, frag_len);
+
+	crc = crc8_ccitt(crc, data, length);
+
+	/* Frames are sent from the nRF RPC threads as well as from the work
+	 * item, when giving credits back.
+	 */
+	k_mutex_lock(&uart_config->tx_lock, K_FOREVER);
+
+	/* Add UART transport header */
+	uart_poll_out(uart_config->uart, 'U');
+	uart_poll_out(uart_config->uart, 'A');
+	uart_poll_out(uart_config->uart, 'R');
+	uart_poll_out(uart_config->uart, 'T');
+	/* Add length */
+	uart_poll_out(uart_config->uart, 0xFF & len_field);
+	uart_poll_out(uart_config->uart, 0xFF & (len_field >> 8));
+	/* Add CRC */
+	uart_poll_out(uart_config->uart, crc);
+
+	for (size_t i = 0; i < frag_len; i++) {
+		uart_poll_out(uart_config->uart, ((const uint8_t *)frag)[i]);
+	}
+
+	for (size_t i = 0; i < length; i++) {
+		uart_poll_out(uart_config->uart, data[i]);
+	}
+
+	k_mutex_unlock(&uart_config->tx_lock);
+}
+
+static void send_credit(struct nrf_rpc_uart *uart_config, uint8_t msg_id, uint16_t index)
+{
+	struct nrf_rpc_uart_frag_header frag = {
+		.kind = NRF_RPC_UART_FRAG_CREDIT,
+		.msg_id = msg_id,
+		.index = index,
+		.value = 1,
+	};
+
+	send_frame(uart_config, sizeof(frag) | NRF_RPC_UART_FRAGMENT_FLAG, &frag, NULL, 0);
+}
+
+static void drop_reassembly(struct nrf_rpc_uart_reassembly *rx)
+{
+	k_free(rx->buf);
+	rx->buf = NULL;
+}
+
+/* Handle a frame carrying a fragment, returns true if it completed a packet,
+ * which is then in uart_config->rx_frag.
+ */
+static bool handle_fragment(struct nrf_rpc_uart *uart_config, size_t len)
+{
+	struct nrf_rpc_uart_reassembly *rx = &uart_config->rx_frag;
+	struct nrf_rpc_uart_frag_header frag;
+
+	if (len < sizeof(frag)) {
+		LOG_WRN("fragment too short (%u bytes)", len);
+		return false;
+	}
+
+	memcpy(&frag, uart_config->packet, sizeof(frag));
+
+	const uint8_t *data = (const uint8_t *)uart_config->packet + sizeof(frag);
+	size_t data_len = len - sizeof(frag);
+
+	if (frag.kind == NRF_RPC_UART_FRAG_CREDIT) {
+		for (uint32_t i = 0; i < frag.value; i++) {
+			k_sem_give(&uart_config->tx_credits);
+		}
+		return false;
+	}
+
+	if (frag.kind != NRF_RPC_UART_FRAG_DATA) {
+		LOG_WRN("unknown fragment kind %u", frag.kind);
+		return false;
+	}
+
+	if (frag.index == 0) {
+		if (rx->buf) {
+			LOG_WRN("packet %u interrupted by packet %u", rx->msg_id, frag.msg_id);
+			drop_reassembly(rx);
+		}
+
+		rx->buf = k_malloc(frag.value);
+		if (!rx->buf) {
+			LOG_ERR("Failed to allocate %u bytes for packet %u",
+				frag.value, frag.msg_id);
+		}
+
+		rx->msg_id = frag.msg_id;
+		rx->total = frag.value;
+		rx->len = 0;
+		rx->index = 0;
+	} else if (rx->buf &&
+		   (rx->msg_id != frag.msg_id || rx->index != frag.index)) {
+		LOG_WRN("unexpected fragment %u:%u, dropping packet",
+			frag.msg_id, frag.index);
+		drop_reassembly(rx);
+	}
+
+	if (rx->buf) {
+		if (rx->len + data_len > rx->total) {
+			LOG_WRN("packet %u longer than advertised, dropping it", rx->msg_id);
+			drop_reassembly(rx);
+		} else {
+			memcpy(rx->buf + rx->len, data, data_len);
+			rx->len += data_len;
+			rx->index++;
+		}
+	}
+
+	/* The fragment has been copied out of the packet buffer, give its
+	 * credit back.
+	 */
+	send_credit(uart_config, frag.msg_id, frag.index);
+
+	return rx->buf && rx->len == rx->total;
+}
+
 static void rpc_tr_uart_handler(struct k_work *item)
 {
 	LOG_DBG("");
@@ -51,9 +194,41 @@ static void rpc_tr_uart_handler(struct k_work *item)
 	__ASSERT_NO_MSG(uart_config->receive_cb);
 	__ASSERT_NO_MSG(uart_config->used);
 
-	ring_buf_get(uart_config->ringbuf, uart_config->packet, header->len);
+	/* Only peek at the data: if the CRC doesn't match, the length field
+	 * might have been corrupted, and the next packet might be located in
+	 * the bytes we would otherwise have thrown away.
+	 */
+	ring_buf_peek(uart_config->ringbuf, uart_config->packet, header->len);
 	LOG_HEXDUMP_DBG(uart_config->packet, header->len, "packet");
 
+	if (compute_crc(header_len_field(header), (const uint8_t *)uart_config->packet,
+			header->len) != header->crc) {
+		uart_config->crc_errors++;
+		LOG_WRN("CRC mismatch, dropping packet (%u errors)", uart_config->crc_errors);
+
+		/* Resume searching for the header magic right after this one */
+		cleanup_state(uart_config);
+		process_ringbuf(uart_config);
+		return;
+	}
+
+	ring_buf_get(uart_config->ringbuf, NULL, header->len);
+
+	if (header->fragment) {
+		struct nrf_rpc_uart_reassembly *rx = &uart_config->rx_frag;
+
+		if (handle_fragment(uart_config, header->len)) {
+			LOG_DBG("calling rx cb, reassembled packet");
+			uart_config->receive_cb(transport, rx->buf, rx->total,
+						uart_config->context);
+			drop_reassembly(rx);
+		}
+
+		cleanup_state(uart_config);
+		process_ringbuf(uart_config);
+		return;
+	}
+
 	LOG_DBG("calling rx cb");
 	/* We memcpy the data out because the packet might reside on the ringbuf
 	 * boundary, and nrf-rpc can't handle that, it expects a single linear
@@ -92,6 +267,10 @@ static bool build_header(struct nrf_rpc_uart *uart_config)
 
 	if (header->idx < 4) {
 		if (byte != "UART"[header->idx]) {
+			/* Restart the search. The current byte might be the
+			 * beginning of the magic.
+			 */
+			header->idx = (byte == 'U') ? 1 : 0;
 			return false;
 		}
 		/* If the rx char matches its required value, header->idx will
@@ -111,6 +290,16 @@ static bool build_header(struct nrf_rpc_uart *uart_config)
 		break;
 	case 5:
 		header->len += byte << 8;
+		header->fragment = header->len & NRF_RPC_UART_FRAGMENT_FLAG;
+		header->len &= NRF_RPC_UART_MAX_LEN;
+		if (header->len > CONFIG_NRF_RPC_UART_BUF_SIZE) {
+			/* Can't be a valid packet, it wouldn't fit in the
+			 * packet buffer.
+			 */
+			LOG_WRN("invalid length %u", header->len);
+			cleanup_state(uart_config);
+			return false;
+		}
 		break;
 	case 6:
 		header->crc = byte;
@@ -125,12 +314,6 @@ static bool build_header(struct nrf_rpc_uart *uart_config)
 	return false;
 }
 
-static uint8_t compute_crc(struct nrf_rpc_uart_header *header, struct ring_buf *buf)
-{
-	/* TODO: implement crc. could be crc8_ccitt() */
-	return header->crc;
-}
-
 static void process_ringbuf(struct nrf_rpc_uart *uart_config)
 {
 	struct nrf_rpc_uart_header *header = uart_config->header;
@@ -142,12 +325,13 @@ static void process_ringbuf(struct nrf_rpc_uart *uart_config)
 	/* receive the packet data */
 	if (build_header(uart_config)) {
 		if (ring_buf_size_get(uart_config->ringbuf) >= header->len) {
-			if (compute_crc(header, uart_config->ringbuf) == header->crc) {
-				LOG_DBG("submit to nrf-rpc");
-				k_work_submit(&uart_config->work);
-				/* LOG_DBG("early return"); */
-				return;
-			}
+			/* The CRC is checked from the work item, once the
+			 * packet has been copied out of the ring buffer.
+			 */
+			LOG_DBG("submit to nrf-rpc");
+			k_work_submit(&uart_config->work);
+			/* LOG_DBG("early return"); */
+			return;
 		}
 	}
 }
@@ -210,6 +394,11 @@ static int init(const struct nrf_rpc_tr *transport,
 	uart_config->context = context;
 	uart_config->used = true;
 
+	k_mutex_init(&uart_config->tx_lock);
+	k_mutex_init(&uart_config->frag_lock);
+	k_sem_init(&uart_config->tx_credits,
+		   CONFIG_NRF_RPC_UART_FRAG_WINDOW, CONFIG_NRF_RPC_UART_FRAG_WINDOW);
+
 	uart_irq_callback_user_data_set(uart_config->uart, serial_cb, (void *)transport);
 	uart_irq_rx_enable(uart_config->uart);
 
@@ -218,6 +407,46 @@ static int init(const struct nrf_rpc_tr *transport,
 	return 0;
 }
 
+BUILD_ASSERT(CONFIG_NRF_RPC_UART_FRAG_SIZE + sizeof(struct nrf_rpc_uart_frag_header) <=
+	     CONFIG_NRF_RPC_UART_BUF_SIZE, "Fragments don't fit in a frame");
+
+/* Send a packet that doesn't fit in a frame. Each fragment takes a credit, the
+ * host gives them back as it consumes the fragments.
+ */
+static int send_fragmented(struct nrf_rpc_uart *uart_config, const uint8_t *data, size_t length)
+{
+	int err = 0;
+
+	/* Fragments of different packets can't be interleaved */
+	k_mutex_lock(&uart_config->frag_lock, K_FOREVER);
+
+	struct nrf_rpc_uart_frag_header frag = {
+		.kind = NRF_RPC_UART_FRAG_DATA,
+		.msg_id = ++uart_config->tx_msg_id,
+		.index = 0,
+		.value = length,
+	};
+
+	for (size_t offset = 0; offset < length; frag.index++) {
+		size_t chunk = MIN(CONFIG_NRF_RPC_UART_FRAG_SIZE, length - offset);
+
+		if (k_sem_take(&uart_config->tx_credits,
+			       K_MSEC(CONFIG_NRF_RPC_UART_FRAG_TIMEOUT_MS))) {
+			LOG_ERR("No credits for fragment %u:%u", frag.msg_id, frag.index);
+			err = -NRF_EAGAIN;
+			break;
+		}
+
+		send_frame(uart_config, (sizeof(frag) + chunk) | NRF_RPC_UART_FRAGMENT_FLAG,
+			   &frag, data + offset, chunk);
+		offset += chunk;
+	}
+
+	k_mutex_unlock(&uart_config->frag_lock);
+
+	return err;
+}
+
 static int send(const struct nrf_rpc_tr *transport, const uint8_t *data, size_t length)
 {
 	LOG_DBG("");
@@ -231,26 +460,19 @@ static int send(const struct nrf_rpc_tr *transport, const uint8_t *data, size_t
 	LOG_DBG("Sending %u bytes", length);
 	DUMP_LIMITED_DBG(data, length, "Data: ");
 
-	/* Add UART transport header */
-	uart_poll_out(uart_config->uart, 'U');
-	uart_poll_out(uart_config->uart, 'A');
-	uart_poll_out(uart_config->uart, 'R');
-	uart_poll_out(uart_config->uart, 'T');
-	/* Add length */
-	uart_poll_out(uart_config->uart, 0xFF & length);
-	uart_poll_out(uart_config->uart, 0xFF & (length >> 8));
-	/* Add CRC (not computed for now) */
-	uart_poll_out(uart_config->uart, 0);
+	int err = 0;
 
-	for (size_t i = 0; i < length; i++) {
-		uart_poll_out(uart_config->uart, data[i]);
+	if (length <= CONFIG_NRF_RPC_UART_BUF_SIZE) {
+		send_frame(uart_config, length, NULL, data, length);
+	} else {
+		err = send_fragmented(uart_config, data, length);
 	}
 
 	k_free((void *)data);
 
 	LOG_DBG("exit");
 
-	return 0;
+	return err;
 }
 
 static void *tx_buf_alloc(const struct nrf_rpc_tr *transport, size_t *size)
@@ -14,6 +14,10 @@ class PacketTransport(ABC):
     def send(self, data, timeout=15):
         pass
 
+    def flush(self, timeout=15):
+        # Block until all the data sent so far is out
+        pass
+
     def clear_buffers(self):
         pass
 
@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import time
+import asyncio
+import logging
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from targettest.abstract_transport import PacketTransport
+from targettest.event_queue import Overflow
+from targettest.rpc_channel import RPCChannel, RPCRequest
+from targettest.rpc_packet import RPCPacket, RPCPacketType
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncRPCChannel(RPCChannel):
+    """RPCChannel variant with an awaitable API.
+
+    Packet handling, request tracking, the event queue and payload encoding are
+    RPCChannel's: only waiting differs, requests and events are awaited instead
+    of blocking the caller. Waiting on a device doesn't block the loop, so a
+    single loop can overlap round-trips to many devices, and up to `window`
+    requests to the same device.
+
+    Works with both the asyncio transport and the threaded ones: packets are
+    always handled from the event loop, which replaces RPCChannel's executor.
+
+    Has to be created from a running event loop, unless one is passed in.
+    """
+    def __init__(self, transport: PacketTransport, default_packet_handler=None, group_name=None,
+                 window=1, loop=None, codecs=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+
+        super().__init__(transport, default_packet_handler, group_name, window, codecs=codecs)
+
+        # Resolved, then replaced, every time an event arrives
+        self._new_evt = self.loop.create_future()
+        self._established = asyncio.Event()
+
+        # Waits for a free slot in the request window without blocking the loop
+        self._slots = asyncio.Semaphore(window)
+
+    def handler(self, packet: RPCPacket):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            super().handler(packet)
+        else:
+            self.loop.call_soon_threadsafe(super().handler, packet)
+
+    def defer(self, packet: RPCPacket):
+        # Already running on the loop
+        self.dispatch(packet)
+
+    def handle_init(self, packet: RPCPacket):
+        super().handle_init(packet)
+        self._established.set()
+
+    def handle_evt(self, packet: RPCPacket):
+        super().handle_evt(packet)
+
+        self._new_evt.set_result(None)
+        self._new_evt = self.loop.create_future()
+
+    async def wait_established(self, timeout=5):
+        try:
+            await asyncio.wait_for(self._established.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise Exception('Unresponsive device')
+
+    async def wait_async(self, request: RPCRequest):
+        """Await the request until its deadline and return the response packet.
+
+        Raises TimeoutError if it didn't arrive in time.
+        """
+        future = asyncio.wrap_future(request, loop=self.loop)
+
+        # Doesn't cancel the request on timeout, unlike asyncio.wait_for()
+        await asyncio.wait([future], timeout=max(0, request.deadline - time.monotonic()))
+
+        if not future.done():
+            with self._completion:
+                if not request.done():
+                    self._expire(request)
+
+        return await future
+
+    async def _submit_async(self, packet_type: RPCPacketType, opcode: int, data: bytes, timeout):
+        # Only take a slot when one is free, so `_submit()` never blocks the loop
+        await asyncio.wait_for(self._slots.acquire(), timeout)
+
+        try:
+            request = self._submit(packet_type, opcode, data, timeout)
+        except Exception:
+            self._slots.release()
+            raise
+
+        request.add_done_callback(
+            lambda _: self.loop.call_soon_threadsafe(self._slots.release))
+
+        return request
+
+    async def evt(self, opcode: int, data: bytes=b'', timeout=5):
+        try:
+            request = await self._submit_async(RPCPacketType.EVT, opcode, data, timeout)
+            await self.wait_async(request)
+        except (asyncio.TimeoutError, TimeoutError, FutureTimeoutError):
+            raise Exception('Async command timeout')
+
+        # Same as RPCChannel.evt()
+        return opcode
+
+    async def evt_cbor(self, opcode: int, data=None, timeout=5):
+        await self.evt(opcode, self.encode_params(opcode, data), timeout=timeout)
+
+    async def cmd(self, opcode: int, data: bytes=b'', timeout=5):
+        # See the warning in RPCChannel.cmd()
+        try:
+            request = await self._submit_async(RPCPacketType.CMD, opcode, data, timeout)
+            return await self.wait_async(request)
+        except (asyncio.TimeoutError, TimeoutError, FutureTimeoutError):
+            raise Exception('Command timeout')
+
+    async def cmd_cbor(self, opcode: int, data=None, timeout=5):
+        rsp = await self.cmd(opcode, self.encode_params(opcode, data), timeout=timeout)
+
+        return self.decode_result(opcode, rsp)
+
+    def subscribe(self, opcode=None, callback=None, predicate=None,
+                  maxsize=1000, overflow=Overflow.DROP_OLDEST, decode=True):
+        """See RPCChannel.subscribe(). Callbacks are called from the event loop.
+
+        Events are delivered from the event loop, which must not block: without
+        a callback, the overflow policy has to drop events (the oldest by default).
+        """
+        if callback is None and overflow == Overflow.BLOCK:
+            raise Exception('Blocking subscriptions would stall the event loop')
+
+        return super().subscribe(opcode, callback, predicate, maxsize, overflow, decode)
+
+    async def _wait_evt(self, opcode, predicate):
+        cursor = 0
+        while True:
+            (packet, cursor) = self.events.poll(opcode, predicate, cursor)
+            if packet is not None:
+                return packet
+
+            await asyncio.shield(self._new_evt)
+
+    async def get_evt(self, opcode=None, timeout=5, predicate=None):
+        """See RPCChannel.get_evt(): only events with `opcode` (any if None)
+        and matching `predicate` are returned, the others stay queued. Raises
+        asyncio.TimeoutError on timeout."""
+        return await asyncio.wait_for(self._wait_evt(opcode, predicate), timeout)
+
+    async def get_evt_cbor(self, opcode=None, timeout=5, predicate=None):
+        evt = await self.get_evt(opcode, timeout, self.decoded_predicate(predicate))
+
+        return (evt, self.codecs.decode(evt.opcode, evt.payload))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # Iterates over the received events, forever
+        return await self.get_evt(timeout=None)
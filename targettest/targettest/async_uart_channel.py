@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import asyncio
+import logging
+import serial
+from targettest.fragment import FragmentLink
+from targettest.uart_channel import UARTFramer
+from targettest.abstract_transport import PacketTransport
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncUARTRPCChannel(PacketTransport):
+    """UART packet transport driven by an asyncio event loop.
+
+    The serial port is registered with the loop instead of being serviced by a
+    dedicated thread, so a single loop can serve many devices. `packet_handler`
+    is called from the loop.
+
+    Only available on POSIX hosts, as it waits on the port's file descriptor.
+    """
+    def __init__(self,
+                 port,
+                 baudrate=1000000,
+                 rtscts=True,
+                 packet_handler=None,
+                 max_frame_size=2048,
+                 trace=None):
+        self.port = port
+        self.packet_handler = packet_handler
+        # Optional, called with ('TX' or 'RX', data) for everything on the wire
+        self.trace = trace
+        # Called from the loop only, see send()
+        self.fragments = FragmentLink(self._send, max_frame_size)
+        self.framer = UARTFramer(self.fragments.handle_rx, max_frame_size)
+        self.loop = None
+
+        # Data that couldn't be written right away
+        self._tx_buf = bytearray()
+        self._tx_drained = None
+
+        # A zero timeout makes both reads and writes non-blocking
+        self._serial = serial.Serial(port=port, baudrate=baudrate, rtscts=rtscts,
+                                     timeout=0, write_timeout=0)
+
+        LOGGER.debug(f'async UART packet channel init: {port}')
+
+    def __repr__(self):
+        return f'{self.port}'
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def open(self):
+        # Has to be called from the event loop
+        self.loop = asyncio.get_running_loop()
+        self._tx_drained = asyncio.Event()
+        self._tx_drained.set()
+        self.loop.add_reader(self._serial.fileno(), self._on_readable)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self._serial.fileno())
+            self.loop.remove_writer(self._serial.fileno())
+
+        self._serial.close()
+
+    def clear_buffers(self):
+        self._serial.reset_input_buffer()
+        self._tx_buf.clear()
+        self.fragments.reset()
+        self._serial.reset_output_buffer()
+
+    def _write(self):
+        byte_count = self._serial.write(self._tx_buf)
+        del self._tx_buf[:byte_count]
+
+        return len(self._tx_buf) == 0
+
+    def _on_writable(self):
+        if self._write():
+            self.loop.remove_writer(self._serial.fileno())
+            self._tx_drained.set()
+
+    def _send(self, data):
+        if self.trace is not None:
+            self.trace('TX', data)
+
+        pending = len(self._tx_buf) > 0
+        self._tx_buf += data
+
+        if pending:
+            # Already waiting for the port to become writable
+            return
+
+        if not self._write():
+            self._tx_drained.clear()
+            self.loop.add_writer(self._serial.fileno(), self._on_writable)
+
+    def send(self, data, timeout=15):
+        LOGGER.debug(f'TX [{self.port}] {data.hex(" ")}')
+
+        if self._in_loop():
+            self.fragments.send(data)
+        else:
+            self.loop.call_soon_threadsafe(self.fragments.send, data)
+
+    async def _drained(self):
+        while True:
+            await self._tx_drained.wait()
+            if self.fragments.idle:
+                return
+
+            # Frames are held back until the device gives credits back
+            await asyncio.sleep(0.001)
+
+    async def drain(self, timeout=15):
+        """Wait until all the data sent so far has been written to the port."""
+        await asyncio.wait_for(self._drained(), timeout)
+
+    def flush(self, timeout=15):
+        if self._in_loop():
+            raise RuntimeError('Blocking flush from the event loop, use `drain()` instead')
+
+        asyncio.run_coroutine_threadsafe(self.drain(timeout), self.loop).result()
+
+    def _on_readable(self):
+        recv = self._serial.read(self._serial.in_waiting or 1)
+        LOGGER.debug(f'RX [{self.port}] {recv.hex(" ")}')
+        if self.trace is not None:
+            self.trace('RX', recv)
+
+        self.handle_rx(recv)
+
+    def handle_rx(self, data: bytes):
+        for packet in self.framer.feed_packets(data):
+            self.packet_handler(packet)
@@ -3,6 +3,7 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
 #
+import collections.abc
 from io import BytesIO
 import cbor2
 
@@ -11,29 +12,69 @@ def encode_null():
     return cbor2.dumps(None)
 
 def encode_obj(obj):
-    return cbor2.dumps(obj)
+    return cbor2.dumps(obj, default=encode_sequence)
+
+def encode_sequence(encoder, value):
+    # Sequences other than lists and tuples (e.g. records, see codec.py) are
+    # encoded as arrays
+    if not isinstance(value, collections.abc.Sequence):
+        raise cbor2.CBOREncodeTypeError(f'cannot serialize type {type(value).__name__}')
+
+    encoder.encode(list(value))
+
+
+# nRF RPC payloads end with a null value
+_NULL = encode_null()
+
+
+def encode_many(objs):
+    """Encode a sequence of objects as an nRF RPC payload."""
+    payload = CBORPayload()
+    payload.extend(objs)
+    return payload.encoded
 
 
 class CBORPayload():
+    """nRF RPC payload, made of CBOR items that aren't wrapped in a container.
+
+    Objects are encoded as they are appended, into a single buffer. The final
+    null value is only added when `encoded` is read, so building a payload
+    takes linear time.
+    """
     def __init__(self, first_obj=None):
-        self.encoded = b''
         self.objects = []
 
-        # End with a null value (nRF RPC limitation)
-        self.encoded += encode_null()
+        self._fp = BytesIO()
+        self._encoder = cbor2.CBOREncoder(self._fp, default=encode_sequence)
+        self._encoded = None
 
         if first_obj is not None:
             self.append(first_obj)
 
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            # End with a null value (nRF RPC limitation)
+            self._encoded = self._fp.getvalue() + _NULL
+
+        return self._encoded
+
     def append(self, obj):
         self.objects.append(obj)
-        self.encoded = self.encoded[:-1] # Remove previous null value
-        self.encoded += encode_obj(obj) + encode_null()
+        self._encoder.encode(obj)
+        self._encoded = None
+
+    def extend(self, objs):
+        encode = self._encoder.encode
+        for obj in objs:
+            self.objects.append(obj)
+            encode(obj)
+
+        self._encoded = None
 
     @classmethod
     def read(cls, payload: bytes):
-        objects = []
-
+        """Returns a CBORPayloadView over `payload`, decoded on demand."""
         # FIXME: the CBOR bytestream nRF RPC / entropy sample output is not
         # compliant: the elements are not wrapped in a container type (e.g. an
         # array/map), and so, compliant libraries such as the python one and the
@@ -45,20 +86,173 @@ class CBORPayload():
         # just serialize the data ourselves (nulling any benefits of the CBOR
         # encoding) or append encoded objects manually (out of spec, but it's
         # what we try to do in this file).
-        with BytesIO(payload) as fp:
+        return CBORPayloadView(payload)
+
+
+# Length of the argument following the initial byte, by additional information
+_ARG_SIZES = {24: 1, 25: 2, 26: 4, 27: 8}
+_BREAK = 0xFF
+
+
+def skip_item(buf, offset=0):
+    """Return the offset of the end of the CBOR item starting at `offset`,
+    without decoding it.
+
+    Raises IndexError if the item is truncated.
+    """
+    initial = buf[offset]
+    major = initial >> 5
+    info = initial & 0x1F
+    offset += 1
+
+    if info < 24:
+        arg = info
+    elif info in _ARG_SIZES:
+        size = _ARG_SIZES[info]
+        if offset + size > len(buf):
+            raise IndexError('truncated CBOR item')
+        arg = int.from_bytes(buf[offset:offset + size], 'big')
+        offset += size
+    elif info == 31:
+        arg = None
+    else:
+        raise ValueError(f'invalid CBOR additional information {info}')
+
+    if major in (0, 1, 7):
+        # Integers, simple values and floats: the argument is the value
+        return offset
+
+    if major == 6:
+        # Tag, followed by the tagged item
+        return skip_item(buf, offset)
+
+    if arg is None:
+        # Indefinite length: chunks or items, until a break
+        while buf[offset] != _BREAK:
+            offset = skip_item(buf, offset)
+            if major == 5:
+                offset = skip_item(buf, offset)
+        return offset + 1
+
+    if major in (2, 3):
+        # Byte and text strings
+        offset += arg
+        if offset > len(buf):
+            raise IndexError('truncated CBOR item')
+        return offset
+
+    # Arrays, and maps (two items per entry)
+    for _ in range(arg if major == 4 else 2 * arg):
+        offset = skip_item(buf, offset)
+
+    return offset
+
+
+class CBORPayloadObjects(collections.abc.Sequence):
+    """Objects of a received payload, only decoded when accessed.
+
+    Items are located with `skip_item`, so reading an object doesn't decode the
+    ones before it. Decoded objects are cached.
+    """
+    def __init__(self, payload: bytes):
+        self._payload = payload
+        self._decoder = cbor2.CBORDecoder(BytesIO(payload))
+
+        # Offsets of the items located so far, the last one might be the end
+        # of the payload
+        self._starts = [0]
+        self._cache = {}
+
+    def _is_item(self, start):
+        # Anything but the end of the payload and the final null value (nRF
+        # RPC limitation)
+        length = len(self._payload)
+        return start < length and not (start == length - 1 and self._payload[start] == 0xF6)
+
+    def _find(self, index):
+        # Offset of the item, or None if the payload doesn't have that many
+        starts = self._starts
+
+        while len(starts) <= index:
+            start = starts[-1]
+            if not self._is_item(start):
+                return None
+
             try:
-                while objects.append(cbor2.load(fp)):
-                    pass
+                starts.append(skip_item(self._payload, start))
+            except IndexError:
+                # Truncated item, same as the end of the stream
+                return None
+
+        start = starts[index]
+        return start if self._is_item(start) else None
+
+    def _decode(self, index, start):
+        if index not in self._cache:
+            self._decoder.fp.seek(start)
+            try:
+                self._cache[index] = self._decoder.decode()
             except cbor2.CBORDecodeEOF:
-                # End of stream has been reached
-                pass
+                # Truncated item, same as the end of the stream
+                raise IndexError('CBOR payload index out of range')
+
+            if len(self._starts) == index + 1:
+                # Located the next item for free
+                self._starts.append(self._decoder.fp.tell())
+
+        return self._cache[index]
+
+    def __len__(self):
+        count = 0
+        while self._find(count) is not None:
+            count += 1
+
+        return count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        start = self._find(index) if index >= 0 else None
+        if start is None:
+            raise IndexError('CBOR payload index out of range')
+
+        return self._decode(index, start)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            start = self._find(index)
+            if start is None:
+                return
+
+            try:
+                obj = self._decode(index, start)
+            except IndexError:
+                return
+
+            yield obj
+            index += 1
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
 
-        # Remove final null value if present
-        if objects[-1] == None:
-            objects = objects[:-1]
 
-        payload = CBORPayload()
-        for obj in objects:
-            payload.append(obj)
+class CBORPayloadView():
+    """Payload returned by CBORPayload.read().
 
-        return payload
+    `encoded` is the received payload, as-is. `objects` is only decoded as it
+    is accessed.
+    """
+    def __init__(self, payload: bytes):
+        self.encoded = payload
+        self.objects = CBORPayloadObjects(payload)
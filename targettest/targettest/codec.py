@@ -0,0 +1,636 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""Per-opcode payload schemas.
+
+A schema describes the first CBOR object of a payload, e.g. for a scan report
+sent as `[[type, addr], adv_type, ad_len, rssi]`:
+
+    BtAddr = record('BtAddr', ('type', int), ('val', bytes))
+    ScanReport = record('ScanReport', ('addr', BtAddr), ('adv_type', int),
+                        ('ad_len', int), ('rssi', int))
+
+    codecs = CodecRegistry()
+    codecs.register(RPCEvents.BT_SCAN_REPORT, ScanReport)
+
+A schema is either:
+- a scalar type: int, bool, float, bytes or str
+- `object`, for anything
+- a record class, made with `record()`, for a fixed-length list
+- a one-item list, e.g. `[int]` or `[BtAddr]`, for a list of any length
+
+Each schema is compiled once into an encode and a decode function. Received
+lists are decoded into records, which have named fields, but can still be used
+like the list they were decoded from.
+
+Fixed-layout schemas, i.e. scalars and records that only hold scalars and
+other fixed-layout records, also get functions generated for them that read
+and write the CBOR bytes directly, without going through cbor2. Payloads they
+don't handle (e.g. a schema mismatch, or an unusual but valid encoding) go
+through the generic path.
+"""
+import struct
+import keyword
+import logging
+import functools
+import collections.abc
+import cbor2
+from targettest.cbor import CBORPayload
+
+LOGGER = logging.getLogger(__name__)
+
+SCALAR_TYPES = (int, bool, float, bytes, str)
+
+
+class SchemaError(Exception):
+    pass
+
+
+class _Fallback(Exception):
+    """Raised by the generated functions when the generic path has to be used."""
+
+
+class Record(collections.abc.Sequence):
+    """Base class of the classes made by `record()`."""
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args):
+        if len(args) != len(self._fields):
+            raise TypeError(f'{type(self).__name__} takes {len(self._fields)} values, '
+                            f'got {len(args)}')
+
+        for (name, value) in zip(self._fields, args):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)
+        return f'{type(self).__name__}({values})'
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [getattr(self, name) for name in self._fields[index]]
+
+        return getattr(self, self._fields[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, (Record, list, tuple)):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+
+def record(name: str, *fields):
+    """Make a Record class, from `(field name, schema)` tuples."""
+    names = tuple(field_name for (field_name, _) in fields)
+
+    cls = type(name, (Record,), {'__slots__': names, '_fields': names})
+    cls._schemas = tuple(schema for (_, schema) in fields)
+
+    return cls
+
+
+def _type_name(value):
+    return type(value).__name__
+
+
+def _compile_scalar(schema):
+    if schema is object:
+        return (lambda value: value, lambda value: value)
+
+    def check(value):
+        # bool is an int for isinstance(), but not for CBOR
+        if type(value) is not schema and not (schema is float and type(value) is int):
+            raise SchemaError(f'expected {schema.__name__}, got {_type_name(value)} {value!r}')
+        return value
+
+    return (check, check)
+
+
+def _compile_list(item_schema):
+    (decode_item, encode_item) = compile_schema(item_schema)
+
+    def apply(convert, value):
+        if not isinstance(value, (list, tuple)):
+            raise SchemaError(f'expected a list, got {_type_name(value)} {value!r}')
+
+        items = []
+        for (index, item) in enumerate(value):
+            try:
+                items.append(convert(item))
+            except SchemaError as e:
+                raise SchemaError(f'[{index}]: {e}') from None
+
+        return items
+
+    return (functools.partial(apply, decode_item), functools.partial(apply, encode_item))
+
+
+def _compile_record(cls):
+    converters = [compile_schema(schema) for schema in cls._schemas]
+    decoders = [decode for (decode, _) in converters]
+    encoders = [encode for (_, encode) in converters]
+    names = cls._fields
+    count = len(names)
+
+    def check_length(value):
+        if not isinstance(value, (list, tuple, Record)) or len(value) != count:
+            raise SchemaError(f'expected {cls.__name__} [{", ".join(names)}], '
+                              f'got {_type_name(value)} {value!r}')
+
+    def apply(convert, value):
+        check_length(value)
+
+        items = []
+        for (name, converter, item) in zip(names, convert, value):
+            try:
+                items.append(converter(item))
+            except SchemaError as e:
+                raise SchemaError(f'{name}: {e}') from None
+
+        return items
+
+    def decode(value):
+        return cls(*apply(decoders, value))
+
+    def encode(value):
+        return apply(encoders, value)
+
+    return (decode, encode)
+
+
+def compile_schema(schema):
+    """Returns the (decode, encode) functions for `schema`.
+
+    decode() takes a decoded CBOR object, and returns it with its lists turned
+    into records. encode() takes an object to send and returns it as plain lists
+    that can be CBOR-encoded. Both raise SchemaError on mismatch.
+    """
+    if isinstance(schema, type) and issubclass(schema, Record):
+        return _compile_record(schema)
+
+    if isinstance(schema, list):
+        if len(schema) != 1:
+            raise ValueError(f'list schemas have exactly one item schema: {schema}')
+        return _compile_list(schema[0])
+
+    if schema is object or schema in SCALAR_TYPES:
+        return _compile_scalar(schema)
+
+    raise ValueError(f'unsupported schema: {schema!r}')
+
+
+def _head(major, arg):
+    # Initial byte and argument of a CBOR item, in the shortest form
+    if arg < 24:
+        return bytes((major << 5 | arg,))
+    if arg < 0x100:
+        return bytes((major << 5 | 24, arg))
+    if arg < 0x10000:
+        return bytes((major << 5 | 25,)) + arg.to_bytes(2, 'big')
+    if arg < 0x100000000:
+        return bytes((major << 5 | 26,)) + arg.to_bytes(4, 'big')
+    return bytes((major << 5 | 27,)) + arg.to_bytes(8, 'big')
+
+_SMALL_INTS = [_head(1, -1 - value) for value in range(-24, 0)] + \
+              [_head(0, value) for value in range(0, 256)]
+
+def _write_int(value):
+    if -24 <= value < 256:
+        return _SMALL_INTS[value + 24]
+    if 0 <= value < 1 << 64:
+        return _head(0, value)
+    if -(1 << 64) <= value < 0:
+        return _head(1, -1 - value)
+    # Big integers are tagged
+    return cbor2.dumps(value)
+
+def _write_bool(value):
+    return b'\xf5' if value else b'\xf4'
+
+def _write_float(value):
+    return cbor2.dumps(value)
+
+def _write_bytes(value):
+    return _head(2, len(value)) + value
+
+def _write_str(value):
+    value = value.encode('utf-8')
+    return _head(3, len(value)) + value
+
+def _read_head(buf, offset, major):
+    initial = buf[offset]
+    if initial >> 5 != major:
+        raise _Fallback
+
+    info = initial & 0x1F
+    if info < 24:
+        return (info, offset + 1)
+    if info == 24:
+        return (buf[offset + 1], offset + 2)
+    if 25 <= info <= 27:
+        end = offset + 1 + (2 << (info - 25))
+        if end > len(buf):
+            raise _Fallback
+        return (int.from_bytes(buf[offset + 1:end], 'big'), end)
+
+    raise _Fallback
+
+def _read_int(buf, offset):
+    if buf[offset] >> 5 == 1:
+        (value, offset) = _read_head(buf, offset, 1)
+        return (-1 - value, offset)
+
+    return _read_head(buf, offset, 0)
+
+def _read_bool(buf, offset):
+    initial = buf[offset]
+    if initial == 0xF5:
+        return (True, offset + 1)
+    if initial == 0xF4:
+        return (False, offset + 1)
+    raise _Fallback
+
+_FLOATS = {0xF9: struct.Struct('>e'), 0xFA: struct.Struct('>f'), 0xFB: struct.Struct('>d')}
+
+def _read_float(buf, offset):
+    layout = _FLOATS.get(buf[offset])
+    if layout is None:
+        raise _Fallback
+    return (layout.unpack_from(buf, offset + 1)[0], offset + 1 + layout.size)
+
+_SCALAR_NAMES = {int: 'int', bool: 'bool', float: 'float', bytes: 'bytes', str: 'str'}
+
+
+def is_fixed_layout(schema):
+    """True for the scalars (except `object`), and for the records that only
+    hold fixed-layout schemas."""
+    if isinstance(schema, type) and issubclass(schema, Record):
+        return all(is_fixed_layout(field) for field in schema._schemas)
+
+    return schema in SCALAR_TYPES
+
+
+class _FixedLayout():
+    """Generates the source of the functions reading and writing the CBOR bytes
+    of a fixed-layout schema."""
+    def __init__(self, schema):
+        self.namespace = {'_Fallback': _Fallback, '_Record': Record,
+                          '_SEQUENCES': (list, tuple), '_new': object.__new__}
+        self.namespace.update({name: value for (name, value) in globals().items()
+                               if name.startswith(('_read_', '_write_'))})
+        self.count = 0
+
+        # Reading: statements, and the variable holding the value
+        self.read_lines = []
+        self.read_value = self._read(schema)
+
+        # Writing: unpacking statements, the scalars with their type, and the
+        # parts of the payload (constant bytes or expressions)
+        self.unpack_lines = []
+        self.leaves = []
+        self.parts = []
+        self._unpack(schema, 'value')
+
+    def _name(self, prefix):
+        self.count += 1
+        return f'{prefix}{self.count}'
+
+    def _constant(self, value):
+        name = self._name('_c')
+        self.namespace[name] = value
+        return name
+
+    def _read(self, schema):
+        lines = self.read_lines
+
+        if schema is int:
+            # Inlined for the values that fit in the initial byte
+            name = self._name('v')
+            lines += [f'{name} = buf[o]',
+                      f'if {name} < 24:',
+                      f'    o += 1',
+                      f'elif 32 <= {name} < 56:',
+                      f'    {name} = 31 - {name}',
+                      f'    o += 1',
+                      f'else:',
+                      f'    ({name}, o) = _read_int(buf, o)']
+            return name
+
+        if schema in (bytes, str):
+            major = 2 if schema is bytes else 3
+            (name, length) = (self._name('v'), self._name('n'))
+            lines += [f'{length} = buf[o] - {major << 5}',
+                      f'if 0 <= {length} < 24:',
+                      f'    o += 1',
+                      f'else:',
+                      f'    ({length}, o) = _read_head(buf, o, {major})',
+                      f'{name} = buf[o:o + {length}]',
+                      f'if len({name}) != {length}: raise _Fallback',
+                      f'o += {length}']
+            if schema is str:
+                lines.append(f'{name} = {name}.decode("utf-8")')
+            return name
+
+        if schema in SCALAR_TYPES:
+            name = self._name('v')
+            lines.append(f'({name}, o) = _read_{_SCALAR_NAMES[schema]}(buf, o)')
+            return name
+
+        header = _head(4, len(schema._fields))
+        if len(header) == 1:
+            lines.append(f'if buf[o] != {header[0]}: raise _Fallback')
+        else:
+            lines.append(f'if buf[o:o + {len(header)}] != {header!r}: raise _Fallback')
+        lines.append(f'o += {len(header)}')
+
+        values = [self._read(field) for field in schema._schemas]
+
+        name = self._name('r')
+        lines.append(f'{name} = _new({self._constant(schema)})')
+        for (field, value) in zip(schema._fields, values):
+            if keyword.iskeyword(field):
+                lines.append(f'setattr({name}, {field!r}, {value})')
+            else:
+                lines.append(f'{name}.{field} = {value}')
+
+        return name
+
+    def _unpack(self, schema, value):
+        if schema in SCALAR_TYPES:
+            self.leaves.append((value, schema))
+            self.parts.append(f'_write_{_SCALAR_NAMES[schema]}({value})')
+            return
+
+        names = [self._name('s') for _ in schema._fields]
+        self.unpack_lines.append(f'if type({value}) not in _SEQUENCES and '
+                                 f'not isinstance({value}, _Record): raise _Fallback')
+        # Raises ValueError if the length doesn't match
+        self.unpack_lines.append(f'[{", ".join(names)}] = {value}')
+        self.parts.append(_head(4, len(names)))
+
+        for (field, name) in zip(schema._schemas, names):
+            self._unpack(field, name)
+
+    def _payload(self):
+        # Consecutive constants are merged, the payload ends with a null value
+        parts = []
+        for part in self.parts + [b'\xf6']:
+            if isinstance(part, bytes) and parts and isinstance(parts[-1], bytes):
+                parts[-1] += part
+            else:
+                parts.append(part)
+
+        return ', '.join(repr(part) if isinstance(part, bytes) else part for part in parts)
+
+    def compile(self, cache_size):
+        """Returns the (read, encode, encode_cached) functions.
+
+        read(payload) returns the value of the first item of the payload, and
+        the offset of the next one. encode(value) returns the payload.
+        encode_cached(value, cache) does the same, with the encoded payloads
+        stored in `cache`, by scalar values.
+        """
+        checks = ' and '.join([f'type({name}) is {_SCALAR_NAMES[schema]}'
+                               for (name, schema) in self.leaves] or ['True'])
+        # -0.0 and 0.0 are equal, but encoded differently
+        key = ''.join(f'{name}.hex(), ' if schema is float else f'{name}, '
+                      for (name, schema) in self.leaves)
+        payload = self._payload()
+
+        unpack = [*self.unpack_lines, f'if not ({checks}): raise _Fallback']
+
+        source = '\n'.join([
+            'def read(buf):',
+            '    o = 0',
+            *(f'    {line}' for line in self.read_lines),
+            f'    return ({self.read_value}, o)',
+            '',
+            'def encode(value):',
+            *(f'    {line}' for line in unpack),
+            f'    return b"".join(({payload},))',
+            '',
+            'def encode_cached(value, cache):',
+            *(f'    {line}' for line in unpack),
+            f'    key = ({key})',
+            '    try:',
+            '        return cache[key]',
+            '    except KeyError:',
+            '        pass',
+            f'    encoded = b"".join(({payload},))',
+            f'    if len(cache) < {cache_size}:',
+            '        cache[key] = encoded',
+            '    return encoded',
+        ])
+
+        exec(source, self.namespace)
+
+        return (self.namespace['read'], self.namespace['encode'],
+                self.namespace['encode_cached'])
+
+
+def _first(payload: bytes):
+    try:
+        return CBORPayload.read(payload).objects[0]
+    except IndexError:
+        return None
+
+
+def _freeze(value):
+    # Hashable version of the value, as cache key
+    if isinstance(value, (list, tuple, Record)):
+        return tuple(_freeze(item) for item in value)
+    return (type(value), value)
+
+
+class Codec():
+    """Encoding and decoding of the payloads of one opcode.
+
+    `schema` is the payload's schema, `result` the one of the payload of the
+    response, for commands.
+
+    With `memoize`, the encoded payloads are cached, for opcodes that are often
+    sent with the same parameters.
+    """
+    CACHE_SIZE = 256
+
+    def __init__(self, opcode: int, schema=None, result=None, memoize=False):
+        self.opcode = opcode
+        self.name = getattr(opcode, 'name', f'{opcode:#04x}')
+        self.schema = schema
+        self.result = result
+
+        self._decode = None
+        self._encode = None
+        self._read = None
+        self._encode_fixed = None
+        self._encode_cached = None
+        if schema is not None:
+            (self._decode, self._encode) = compile_schema(schema)
+
+            if is_fixed_layout(schema):
+                (self._read, self._encode_fixed, self._encode_cached) = \
+                    _FixedLayout(schema).compile(self.CACHE_SIZE)
+
+        self._decode_result = None
+        self._read_result = None
+        if result is not None:
+            (self._decode_result, _) = compile_schema(result)
+
+            if is_fixed_layout(result):
+                (self._read_result, _, _) = _FixedLayout(result).compile(self.CACHE_SIZE)
+
+        # Encoded payloads, by parameters
+        self._cache = {} if memoize else None
+
+    def __repr__(self):
+        return f'Codec {self.name}'
+
+    def _encode_uncached(self, data):
+        if self._encode is not None:
+            data = self._encode(data)
+
+        return CBORPayload(data).encoded
+
+    def encode(self, data):
+        if self._encode_fixed is not None:
+            try:
+                if self._cache is None:
+                    return self._encode_fixed(data)
+
+                return self._encode_cached(data, self._cache)
+
+            except (_Fallback, ValueError):
+                # Mismatch, or e.g. an int for a float: the generic path
+                # raises or converts it
+                return self._encode_uncached(data)
+
+        if self._cache is None:
+            return self._encode_uncached(data)
+
+        key = _freeze(data)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Not hashable
+            return self._encode_uncached(data)
+
+        encoded = self._encode_uncached(data)
+        if len(self._cache) < self.CACHE_SIZE:
+            self._cache[key] = encoded
+
+        return encoded
+
+    def decode(self, obj):
+        """Check a decoded CBOR object against the schema."""
+        return obj if self._decode is None else self._decode(obj)
+
+    def decode_result(self, obj):
+        return obj if self._decode_result is None else self._decode_result(obj)
+
+    def read(self, payload: bytes):
+        """First object of a received payload, decoded."""
+        if self._read is not None:
+            try:
+                return self._read(bytes(payload))[0]
+            except (_Fallback, IndexError, ValueError, struct.error):
+                pass
+
+        return self.decode(_first(payload))
+
+    def read_result(self, payload: bytes):
+        """Objects of a command's response, the first one decoded."""
+        if self._read_result is not None:
+            payload = bytes(payload)
+            try:
+                (first, end) = self._read_result(payload)
+                return [first] + list(CBORPayload.read(payload[end:]).objects)
+            except (_Fallback, IndexError, ValueError, struct.error):
+                pass
+
+        objects = CBORPayload.read(payload).objects
+        if len(objects) == 0:
+            return objects
+
+        return [self.decode_result(objects[0])] + objects[1:]
+
+
+class CodecRegistry():
+    """Codecs, by opcode. Payloads of the opcodes without a codec are encoded
+    and decoded as-is.
+
+    Every schema mismatch goes through `mismatch()`: it is logged, counted, and
+    raised as a SchemaError that names the opcode and the offending field.
+    """
+    def __init__(self):
+        self._codecs = {}
+        self.mismatches = 0
+
+    def __contains__(self, opcode):
+        return opcode in self._codecs
+
+    def register(self, opcode: int, schema=None, result=None, memoize=False):
+        codec = Codec(opcode, schema, result, memoize)
+        self._codecs[opcode] = codec
+
+        return codec
+
+    def get(self, opcode):
+        return self._codecs.get(opcode)
+
+    def mismatch(self, codec: Codec, error: SchemaError):
+        self.mismatches += 1
+        message = f'{codec.name}: {error}'
+        LOGGER.error(f'schema mismatch: {message}')
+
+        raise SchemaError(message) from None
+
+    def encode(self, opcode: int, data):
+        """Payload for `data`, sent with `opcode`."""
+        codec = self._codecs.get(opcode)
+        if codec is None:
+            return CBORPayload(data).encoded
+
+        try:
+            return codec.encode(data)
+        except SchemaError as e:
+            self.mismatch(codec, e)
+
+    def decode(self, opcode: int, payload: bytes):
+        """First object of a received payload, as a record if it has a schema."""
+        codec = self._codecs.get(opcode)
+        if codec is None:
+            return _first(payload)
+
+        try:
+            return codec.read(payload)
+        except SchemaError as e:
+            self.mismatch(codec, e)
+
+    def decode_result(self, opcode: int, payload: bytes):
+        """Objects of a command's response, the first one as a record if the
+        command has a result schema."""
+        codec = self._codecs.get(opcode)
+        if codec is None or codec.result is None:
+            return CBORPayload.read(payload).objects
+
+        try:
+            return codec.read_result(payload)
+        except SchemaError as e:
+            self.mismatch(codec, e)
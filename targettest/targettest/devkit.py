@@ -6,9 +6,15 @@
 import threading
 import time
 import logging
+import multiprocessing
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from pynrfjprog import LowLevel, APIError
 from pynrfjprog import Parameters
+from targettest.log_buffer import LogBuffer
+from targettest.inventory import Inventory
+from targettest.flash_state import hex_digest
+from targettest import flash_diff
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,19 +46,23 @@ def select_core(api, core):
     LOGGER.debug(f'[{cpu.name}] select core')
     api.select_coprocessor(cpu)
 
+def connect_device(api, family, core):
+    """Connect to the device, recovering it if it is protected."""
+    try:
+        api.connect_to_device()
+    except APIError.APIError as e:
+        if family != 'NRF52':
+            select_core(api, 'NET')
+            api.recover()
+
+        select_core(api, 'APP')
+        api.recover()
+        select_core(api, core)
+
 @contextmanager
 def SeggerDevice(family='UNKNOWN', id=None, core='APP'):
     with SeggerEmulator(family, id, core=core) as api:
-        try:
-            api.connect_to_device()
-        except APIError.APIError as e:
-            if family != 'NRF52':
-                select_core(api, 'NET')
-                api.recover()
-
-            select_core(api, 'APP')
-            api.recover()
-            select_core(api, core)
+        connect_device(api, family, core)
 
         LOGGER.debug(f'[{id}] jlink open')
 
@@ -62,7 +72,176 @@ def SeggerDevice(family='UNKNOWN', id=None, core='APP'):
         LOGGER.debug(f'[{id}] jlink closed')
 
 
+class JLinkSession():
+    """Connection to an emulator, kept open by the SessionPool."""
+    def __init__(self, id, family='UNKNOWN'):
+        self.id = id
+        self.family = family
+        self.core = None
+        self.users = 0
+
+        self.api = LowLevel.API(family)
+        self.api.open()
+        try:
+            self.api.connect_to_emu_with_snr(id, 4000)
+        except Exception:
+            self.api.close()
+            raise
+
+        LOGGER.debug(f'[{id}] jlink session open')
+
+    def __repr__(self):
+        return f'JLinkSession {self.id} {self.family} {self.core}'
+
+    def healthy(self):
+        try:
+            if not self.api.is_connected_to_emu():
+                return False
+
+            return self.core is None or self.api.is_connected_to_device()
+
+        except APIError.APIError:
+            return False
+
+    def use(self, core='APP'):
+        """Connect to the device's `core`, returns the API."""
+        if self.core == core:
+            return self.api
+
+        if self.core is not None:
+            self.api.disconnect_from_device()
+            self.core = None
+
+        LOGGER.debug(f'[{self.id}] switch to {core} core')
+        select_core(self.api, core)
+        connect_device(self.api, self.family, core)
+        self.core = core
+
+        return self.api
+
+    def close(self):
+        try:
+            if self.core is not None:
+                self.api.disconnect_from_device()
+            self.api.disconnect_from_emu()
+
+        except APIError.APIError as e:
+            LOGGER.debug(f'[{self.id}] jlink session close: {e}')
+
+        finally:
+            self.api.close()
+            self.core = None
+            LOGGER.debug(f'[{self.id}] jlink session closed')
+
+
+class SessionPool():
+    """J-Link sessions, by serial number.
+
+    Opening the API and connecting to the emulator and device takes time, and
+    provisioning a device takes several operations in a row (flashing both
+    cores, reset, halt, RTT). A session is opened the first time an emulator is
+    used, and kept open until `close()`. It is checked before being handed out,
+    and re-opened if the connection has been lost.
+
+    A session is never closed while it is borrowed (e.g. by a Devkit and its
+    RTT logger): asking for it with another family, or after its connection
+    has been lost, raises instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def acquire(self, id, family='UNKNOWN'):
+        id = int(id)
+
+        with self._lock:
+            session = self._sessions.get(id)
+
+            if session is not None and family not in ('UNKNOWN', session.family):
+                if session.users > 0:
+                    raise Exception(f'[{id}] jlink session in use for {session.family}, '
+                                    f'unable to re-open it for {family}')
+
+                LOGGER.debug(f'[{id}] re-opening session for {family}')
+                self._close(session)
+                session = None
+
+            elif session is not None and not session.healthy():
+                if session.users > 0:
+                    raise Exception(f'[{id}] jlink session lost while in use')
+
+                LOGGER.warning(f'[{id}] jlink session lost, re-opening it')
+                self._close(session)
+                session = None
+
+            if session is None:
+                session = JLinkSession(id, family)
+                self._sessions[id] = session
+
+            session.users += 1
+
+            return session
+
+    def release(self, session: JLinkSession):
+        with self._lock:
+            session.users -= 1
+
+    @contextmanager
+    def emulator(self, id, family='UNKNOWN'):
+        """Borrow a session, without connecting to the device."""
+        session = self.acquire(id, family)
+        try:
+            yield session.api
+        finally:
+            self.release(session)
+
+    @contextmanager
+    def device(self, id, family, core='APP'):
+        """Borrow a session connected to the device's `core`."""
+        session = self.acquire(id, family)
+        try:
+            yield session.use(core)
+        finally:
+            self.release(session)
+
+    def _close(self, session):
+        del self._sessions[session.id]
+        session.close()
+
+    def close(self, id=None):
+        """Close the session of emulator `id`, or all of them.
+
+        Closing a single session that is in use raises. Closing all of them is
+        done at the end of the session, the ones still in use are closed anyway.
+        """
+        with self._lock:
+            if id is not None:
+                session = self._sessions.get(int(id))
+                if session is not None:
+                    if session.users > 0:
+                        raise Exception(f'[{id}] unable to close jlink session in use')
+                    self._close(session)
+                return
+
+            for session in list(self._sessions.values()):
+                if session.users > 0:
+                    LOGGER.warning(f'[{session.id}] closing jlink session in use')
+                self._close(session)
+
+SESSIONS = SessionPool()
+
+
 class RTTLogger(threading.Thread):
+    """Reads the RTT log channel of the device.
+
+    While data is coming in, blocks of `READ_SIZE` are read back-to-back so the
+    device's RTT buffer doesn't overflow. When the channel is idle, the polling
+    interval doubles up to `MAX_INTERVAL`.
+    """
+    READ_SIZE = 4096
+    MIN_INTERVAL = .001
+    MAX_INTERVAL = .05
+
     def __init__(self, emu, handler):
         threading.Thread.__init__(self, daemon=True)
         self._stop_rx_flag = threading.Event() # Used to cleanly stop the RX thread
@@ -70,6 +249,9 @@ class RTTLogger(threading.Thread):
         self.handler = handler
         self.emu = emu
 
+        self.bytes_read = 0
+        self.reads = 0
+
     def run(self):
         LOGGER.debug(f'RTT start')
         self._stop_rx_flag.clear()
@@ -83,13 +265,24 @@ class RTTLogger(threading.Thread):
         self.ready = True
 
         LOGGER.debug(f'RTT opened')
+        interval = self.MIN_INTERVAL
         while not self._stop_rx_flag.isSet():
-            recv = self.emu.rtt_read(0, 255)
+            recv = self.emu.rtt_read(0, self.READ_SIZE)
+            self.reads += 1
+
             if len(recv) > 0:
+                self.bytes_read += len(recv)
                 self.handler(recv)
+                interval = self.MIN_INTERVAL
+
+                if len(recv) == self.READ_SIZE:
+                    # There is likely more data waiting
+                    continue
+            else:
+                interval = min(interval * 2, self.MAX_INTERVAL)
 
-            # Yield to other threads
-            time.sleep(.01)
+            # Also yields to the other threads
+            self._stop_rx_flag.wait(interval)
 
         LOGGER.debug(f'RTT stop')
         self.emu.rtt_stop()
@@ -112,16 +305,39 @@ class Devkit:
         self.name = name
         self.in_use = False
 
-        self.log = ''
+        self.logs = LogBuffer()
 
     def __repr__(self):
         return f'{self.name}: {self.segger_id} {self.port} '
 
+    @property
+    def log(self):
+        """The device log received since `start_logging()`."""
+        return self.logs.getvalue()
+
+    @property
+    def has_logs(self):
+        """Whether the device log is received, it needs the emulator (RTT)."""
+        return self.emu is not None
+
     def log_handler(self, rx: str):
-        self.log += rx
+        self.logs.append(rx)
+
+    def log_marker(self):
+        """Marker for `wait_for_log()`: only the log lines received after
+        this call will be examined."""
+        return self.logs.mark()
+
+    def wait_for_log(self, pattern, timeout=5, since=0):
+        """Wait for a line of device log matching the `pattern` regex.
+
+        Returns a LogMatch, whose `marker` can be used as `since` to wait for
+        the lines that follow. Raises TimeoutError.
+        """
+        return self.logs.wait_for(pattern, timeout, since)
 
     def start_logging(self):
-        self.log = ''
+        self.logs.clear()
 
         if self.emu is None:
             LOGGER.debug(f'[{self.segger_id}] skipping log setup')
@@ -145,7 +361,11 @@ class Devkit:
         try:
             self.rtt.close()
         finally:
-            LOGGER.debug(f'[{self.segger_id}] logging stopped')
+            LOGGER.debug(f'[{self.segger_id}] logging stopped: '
+                         f'{self.rtt.bytes_read} bytes in {self.rtt.reads} reads')
+
+        if self.logs.dropped:
+            LOGGER.warning(f'[{self.segger_id}] {self.logs.dropped} bytes of log dropped')
 
     def open(self, open_emu):
         LOGGER.debug(f'[{self.segger_id}] devkit open')
@@ -153,18 +373,19 @@ class Devkit:
 
         # Don't try to fetch the port path if supplied
         if self.port is None:
-            self.port = get_serial_port(self.segger_id)
+            self.port = get_serial_port(self.segger_id, self.family)
 
         if open_emu:
-            self.apiobject = SeggerDevice(self.family, self.segger_id)
-            self.emu = self.apiobject.__enter__()
+            self.session = SESSIONS.acquire(self.segger_id, self.family)
+            self.emu = self.session.use('APP')
 
     def close(self):
         LOGGER.debug(f'[{self.segger_id}] devkit close')
         self.in_use = False
 
         if self.emu is not None:
-            self.apiobject.__exit__(None, None, None)
+            SESSIONS.release(self.session)
+            self.emu = None
 
     def available(self):
         return not self.in_use
@@ -183,14 +404,67 @@ class Devkit:
             halt(self.segger_id, self.family, self.emu)
 
 
-def get_serial_port(id):
-    with SeggerEmulator() as api:
+def get_serial_port(id, family='UNKNOWN'):
+    with SESSIONS.emulator(id, family) as api:
         # Will get the last serial port. This is connected to the APP core
         # on nRF53 DKs.
         return api.enum_emu_com_ports(id)[-1].path
 
-def flash(id, family, hex_path, core='APP', reset=True):
-    with SeggerDevice(family, id, core) as cpu:
+def has_firmware(cpu, hex_path):
+    """Check the device's flash against a hex file. Hashing is done on the
+    device, which is much faster than reading the flash back."""
+    try:
+        cpu.verify_file(str(hex_path), Parameters.VerifyAction.VERIFY_HASH)
+        return True
+    except APIError.APIError:
+        return False
+
+def flash_changed_pages(cpu, id, family, core, hex_path, old_hex_path):
+    """Flash the pages that differ from the image on the device. Returns False
+    if the whole image has to be flashed instead."""
+    if old_hex_path is None or not has_firmware(cpu, old_hex_path):
+        LOGGER.debug(f'[{id}] [{family}-{core}] Previous image unknown')
+        return False
+
+    diff = flash_diff.plan(family, core, old_hex_path, hex_path)
+    if diff is None:
+        return False
+
+    (ih, pages, page_size) = diff
+    LOGGER.info(f'[{id}] [{family}-{core}] Flashing {len(pages)} changed pages '
+                f'with {str(hex_path)}')
+    flash_diff.flash_pages(cpu, ih, pages, page_size)
+
+    return True
+
+def flash(id, family, hex_path, core='APP', reset=True, state=None):
+    """Flash the device's `core` with a hex file.
+
+    With a FlashState, flashing is skipped if the hex file is the one that was
+    last flashed on the core, and the device still has it. If the state is
+    `differential`, and the device still has the image last flashed on the
+    core, only the pages that changed are flashed. Returns True if the device
+    has been flashed.
+    """
+    digest = hex_digest(hex_path) if state is not None else None
+
+    with SESSIONS.device(id, family, core) as cpu:
+        if digest is not None and state.get(id, core) == digest:
+            if has_firmware(cpu, hex_path):
+                LOGGER.info(f'[{id}] [{family}-{core}] Already flashed with {str(hex_path)}')
+                return False
+
+            LOGGER.info(f'[{id}] [{family}-{core}] Flash content changed, re-flashing')
+
+        if state is not None:
+            # Not trusted anymore if flashing is interrupted
+            state.forget(id, core)
+
+        if state is not None and state.differential:
+            if flash_changed_pages(cpu, id, family, core, hex_path, state.image(id, core)):
+                state.set(id, core, digest, hex_path)
+                return True
+
         LOGGER.info(f'[{id}] [{family}-{core}] Flashing with {str(hex_path)}')
         # Erase the target's flash
         cpu.erase_file(hex_path)
@@ -199,13 +473,36 @@ def flash(id, family, hex_path, core='APP', reset=True):
         cpu.program_file(hex_path)
         cpu.verify_file(hex_path)
 
+        if state is not None:
+            state.set(id, core, digest, hex_path)
+
+    return True
+
+def flash_cores(id, family, steps, state=None):
+    """Flash the cores of a device, in order. `steps` are (core, hex_path)
+    tuples. Returns the (core, flashed, duration) of each step."""
+    results = []
+    for (core, hex_path) in steps:
+        start = time.monotonic()
+        flashed = flash(id, family, hex_path, core, state=state)
+        results.append((core, flashed, time.monotonic() - start))
+
+    return results
+
+def flash_cores_process(id, family, steps, state=None):
+    # Runs in a worker process, which has its own session pool
+    try:
+        return flash_cores(id, family, steps, state)
+    finally:
+        SESSIONS.close()
+
 def reset(id, family, emu=None):
     if emu is not None:
         LOGGER.info(f'[{id}] reset')
         # emu.debug_reset()
         emu.pin_reset()
     else:
-        with SeggerDevice(family, id) as emu:
+        with SESSIONS.device(id, family) as emu:
             LOGGER.info(f'[{id}] reset')
             emu.pin_reset()
             # Other ways to reset the device:
@@ -218,24 +515,63 @@ def halt(id, family, emu=None):
     if emu is not None:
         emu.halt()
     else:
-        with SeggerDevice(family, id) as emu:
+        with SESSIONS.device(id, family) as emu:
             emu.halt()
 
 def halt_unused(devkits: list):
     unused = [dk for dk in devkits if not dk.in_use]
     for dk in unused:
         halt(dk.segger_id, dk.family)
+        # Not kept in the pool: leave the emulator to the other tools
+        SESSIONS.close(dk.segger_id)
+
+def probe_family(id):
+    # Runs in a worker process spawned by discover_dks()
+    with SeggerEmulator(id=id) as api:
+        return api.read_device_family()
+
+def discover_dks(inventory=None, workers=None):
+    """Find the connected DKs.
+
+    Only the emulators that are not in the `inventory` (or whose entry is
+    outdated) are connected to, in parallel, to read their device family.
+    Each one is probed from its own process, so that the slow, blocking
+    nrfjprog calls overlap without sharing any library state.
+    """
+    if inventory is None:
+        inventory = Inventory()
 
-def discover_dks():
     with SeggerEmulator() as api:
-        ids = api.enum_emu_snr()
-        devkits = []
-        for id in ids:
-            api.connect_to_emu_with_snr(id)
-            family = api.read_device_family()
-            port = api.enum_emu_com_ports(id)[-1].path
-            devkits.append(
-                Devkit(id, family, f'dk-{family}-{id}', port))
-            api.disconnect_from_emu()
+        # Doesn't require connecting to the emulators
+        ports = {id: [port.path for port in api.enum_emu_com_ports(id)]
+                 for id in (api.enum_emu_snr() or [])}
+
+    stale = inventory.sync(ports)
+    if len(stale) > 0:
+        LOGGER.info(f'Probing devices: {stale}')
+        start = time.monotonic()
+
+        # Not forked: the workers must not inherit the J-Link library state
+        # and the sessions of this process
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers or len(stale), mp_context=context) as pool:
+            futures = {id: pool.submit(probe_family, id) for id in stale}
+
+            for (id, future) in futures.items():
+                try:
+                    inventory.add(id, future.result(), ports[id])
+                except Exception as e:
+                    LOGGER.warning(f'[{id}] unable to probe device: {e}')
+                    inventory.forget(id)
+
+        LOGGER.info(f'Probed {len(stale)} devices in {time.monotonic() - start:.1f}s')
+
+    inventory.save()
+
+    devkits = []
+    for (id, entry) in inventory.entries.items():
+        family = entry['family']
+        # The last serial port is connected to the APP core on nRF53 DKs
+        devkits.append(Devkit(id, family, f'dk-{family}-{id}', entry['ports'][-1]))
 
     return devkits
@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import threading
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OrderedDispatcher():
+    """Runs calls on an executor, in submission order for a given key.
+
+    Calls with different keys can run concurrently if the executor has more than
+    one worker. Without an executor, one with a single worker is created on the
+    first call, so everything runs in order.
+    """
+    # Calls made for a key before giving the executor to the other keys
+    BATCH_SIZE = 16
+
+    def __init__(self, executor=None, name='dispatch'):
+        self.name = name
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._lock = threading.RLock()
+        self._pending = {}
+        self.closed = False
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+
+        return self._executor
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            if self.closed:
+                LOGGER.debug(f'{self.name}: closed, dropping call to {fn}')
+                return
+
+            if key in self._pending:
+                # Already being drained
+                self._pending[key].append((fn, args))
+                return
+
+            self._pending[key] = collections.deque([(fn, args)])
+            # Under the lock, so that close() can't shut the executor down first
+            self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        for _ in range(self.BATCH_SIZE):
+            with self._lock:
+                pending = self._pending[key]
+                if len(pending) == 0:
+                    del self._pending[key]
+                    return
+
+                (fn, args) = pending.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                LOGGER.exception(f'{self.name}: call to {fn} failed')
+
+        # Let the other keys run, the key stays registered so that its calls
+        # are still made in order
+        with self._lock:
+            if self.closed:
+                del self._pending[key]
+                return
+
+            self.executor.submit(self._drain, key)
+
+    def clear(self):
+        """Drop the calls that haven't started yet."""
+        with self._lock:
+            # Emptied in place: only the running drains remove their key
+            for pending in self._pending.values():
+                pending.clear()
+
+    def close(self):
+        self.clear()
+
+        with self._lock:
+            self.closed = True
+
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,290 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import enum
+import time
+import queue
+import logging
+import threading
+import collections
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Entry():
+    __slots__ = ('seq', 'packet', 'consumed')
+
+    def __init__(self, seq, packet):
+        self.seq = seq
+        self.packet = packet
+        self.consumed = False
+
+
+class EventQueue():
+    """Received events, indexed by opcode.
+
+    Events are kept both in arrival order and in one FIFO per opcode, so that
+    waiting for a given opcode only looks at the events with that opcode, and
+    leaves the others queued.
+
+    Entries that are consumed through one index are dropped from the other
+    once they reach its head, or when consumed entries make up most of it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._count = 0
+        self._all = collections.deque()
+        self._by_opcode = collections.defaultdict(collections.deque)
+        # Events not consumed yet, by opcode
+        self._live = collections.Counter()
+
+    def __len__(self):
+        return self._count
+
+    def qsize(self):
+        return self._count
+
+    def empty(self):
+        return self._count == 0
+
+    def put(self, packet):
+        with self._cond:
+            self._seq += 1
+            entry = _Entry(self._seq, packet)
+
+            self._all.append(entry)
+            self._by_opcode[packet.opcode].append(entry)
+            self._live[packet.opcode] += 1
+            self._count += 1
+
+            self._cond.notify_all()
+
+    def clear(self):
+        with self._cond:
+            self._all.clear()
+            self._by_opcode.clear()
+            self._live.clear()
+            self._count = 0
+
+    @staticmethod
+    def _compact_index(events, live):
+        while events and events[0].consumed:
+            events.popleft()
+
+        if len(events) >= 2 * live + 32:
+            kept = [entry for entry in events if not entry.consumed]
+            events.clear()
+            events.extend(kept)
+
+    def _compact(self, opcode):
+        # Each index is compacted on its own count of consumed entries
+        self._compact_index(self._all, self._count)
+
+        if self._live[opcode] == 0:
+            del self._by_opcode[opcode]
+            del self._live[opcode]
+        else:
+            self._compact_index(self._by_opcode[opcode], self._live[opcode])
+
+    def _find(self, opcode, predicate, cursor):
+        if opcode is None:
+            events = self._all
+        elif opcode in self._by_opcode:
+            events = self._by_opcode[opcode]
+        else:
+            return None
+
+        while events and events[0].consumed:
+            events.popleft()
+
+        if predicate is None:
+            return events[0] if events else None
+
+        # Only check the events that arrived since the last call
+        new = []
+        for entry in reversed(events):
+            if entry.seq <= cursor:
+                break
+            new.append(entry)
+
+        for entry in reversed(new):
+            if not entry.consumed and predicate(entry.packet):
+                return entry
+
+        return None
+
+    def poll(self, opcode=None, predicate=None, cursor=0):
+        """Pop the oldest event matching `opcode` and `predicate`, if any.
+
+        Returns a (packet, cursor) tuple, with packet None if nothing matched.
+        Pass the cursor to the next call to only check events received since
+        this one.
+        """
+        with self._cond:
+            entry = self._find(opcode, predicate, cursor)
+            cursor = self._seq
+
+            if entry is None:
+                return (None, cursor)
+
+            entry.consumed = True
+            self._live[entry.packet.opcode] -= 1
+            self._count -= 1
+            self._compact(entry.packet.opcode)
+
+            return (entry.packet, cursor)
+
+    def get(self, opcode=None, predicate=None, timeout=None):
+        """Pop the oldest event matching `opcode` and `predicate` (called with
+        the packet), waiting for it if needed.
+
+        Raises queue.Empty on timeout, like queue.Queue.
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        cursor = 0
+        with self._cond:
+            while True:
+                (packet, cursor) = self.poll(opcode, predicate, cursor)
+                if packet is not None:
+                    return packet
+
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+
+                    self._cond.wait(remaining)
+
+
+class Overflow(enum.Enum):
+    """What a full Subscription does with a new event."""
+    BLOCK = enum.auto()
+    DROP_OLDEST = enum.auto()
+    DROP_NEWEST = enum.auto()
+
+
+class Subscription():
+    """Events with a given opcode and/or matching a predicate.
+
+    `predicate` is called with the raw event packet. The events are decoded
+    and either passed to `callback(packet, payload)`, or stored until they are
+    consumed with `get()` or by iterating over the subscription.
+
+    At most `maxsize` events are stored. Once full, `overflow` decides whether
+    delivery blocks until there is room (and with it, the ACK to the device),
+    or whether the oldest or newest event is dropped. `dropped` counts the
+    dropped events.
+
+    Created by `RPCChannel.subscribe()`.
+    """
+    def __init__(self, opcode=None, predicate=None, callback=None,
+                 maxsize=1000, overflow=Overflow.BLOCK, decode=True):
+        self.opcode = opcode
+        self.predicate = predicate
+        self.callback = callback
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.decode = decode
+
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+
+        self._cond = threading.Condition()
+        self._items = collections.deque()
+
+    def __repr__(self):
+        opcode = 'any' if self.opcode is None else f'{self.opcode:02x}'
+        return (f'Subscription {opcode} received {self.received} '
+                f'dropped {self.dropped} queued {len(self._items)}')
+
+    def __len__(self):
+        return len(self._items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.get()
+        except EOFError:
+            raise StopIteration
+
+    def matches(self, packet):
+        if self.closed:
+            return False
+
+        if self.opcode is not None and packet.opcode != self.opcode:
+            return False
+
+        return self.predicate is None or self.predicate(packet)
+
+    def deliver(self, packet, payload=None):
+        """Called on reception of a matching event."""
+        self.received += 1
+        item = (packet, payload)
+
+        if self.callback is not None:
+            try:
+                self.callback(*item)
+            except Exception:
+                LOGGER.exception(f'{self}: callback failed on {packet}')
+            return
+
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                if self.overflow == Overflow.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+
+                elif self.overflow == Overflow.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+
+                else:
+                    while len(self._items) >= self.maxsize and not self.closed:
+                        self._cond.wait()
+
+                    if self.closed:
+                        self.dropped += 1
+                        return
+
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Pop the oldest (packet, payload) tuple, waiting for it if needed.
+
+        Raises queue.Empty on timeout, and EOFError once the subscription is
+        closed and all its events have been consumed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed, timeout):
+                raise queue.Empty
+
+            if not self._items:
+                raise EOFError(f'{self} closed')
+
+            item = self._items.popleft()
+            self._cond.notify_all()
+
+            return item
+
+    def close(self):
+        """Stop receiving events. Those already stored can still be consumed."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
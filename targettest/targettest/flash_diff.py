@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""Differential flashing: only the flash pages that differ between the image on
+the device and the new one are erased and written."""
+import logging
+from intelhex import IntelHex
+
+LOGGER = logging.getLogger(__name__)
+
+# Internal flash of each (family, core): (start, end, page size). The other
+# regions (e.g. UICR) can't be erased page by page.
+FLASH_REGIONS = {('NRF52', 'APP'): (0x00000000, 0x00100000, 0x1000),
+                 ('NRF53', 'APP'): (0x00000000, 0x00100000, 0x1000),
+                 ('NRF53', 'NET'): (0x01000000, 0x01040000, 0x800)}
+
+# Above this share of changed pages, a full erase and program is faster
+MAX_CHANGED_RATIO = .5
+
+ERASED = 0xFF
+
+
+def _pages(ih: IntelHex, page_size):
+    pages = set()
+    for (start, end) in ih.segments():
+        pages.update(range(start - start % page_size, end, page_size))
+
+    return pages
+
+def changed_pages(old: IntelHex, new: IntelHex, page_size):
+    """Start addresses of the pages whose content differs, in order."""
+    changed = []
+    for page in sorted(_pages(old, page_size) | _pages(new, page_size)):
+        end = page + page_size - 1
+        if old.tobinstr(page, end) != new.tobinstr(page, end):
+            changed.append(page)
+
+    return changed
+
+def plan(family, core, old_hex, new_hex):
+    """The pages to re-flash, or None if the whole image has to be flashed."""
+    region = FLASH_REGIONS.get((family, core))
+    if region is None:
+        return None
+
+    (region_start, region_end, page_size) = region
+    old = IntelHex(str(old_hex))
+    new = IntelHex(str(new_hex))
+
+    pages = changed_pages(old, new, page_size)
+    if any(not region_start <= page < region_end for page in pages):
+        LOGGER.debug(f'{core}: changes outside of the flash')
+        return None
+
+    total = len(_pages(new, page_size))
+    if len(pages) > total * MAX_CHANGED_RATIO:
+        LOGGER.debug(f'{core}: {len(pages)} of {total} pages changed')
+        return None
+
+    return (new, pages, page_size)
+
+def _page_data(ih: IntelHex, page, page_size):
+    data = ih.tobinstr(page, page + page_size - 1).rstrip(bytes([ERASED]))
+    # Flash is written by words
+    padding = -len(data) % 4
+    return data + bytes([ERASED]) * padding
+
+def flash_pages(cpu, ih: IntelHex, pages, page_size):
+    """Erase and write `pages` with the content of `ih`, then read them back."""
+    for page in pages:
+        cpu.erase_page(page)
+
+        data = _page_data(ih, page, page_size)
+        if len(data) > 0:
+            cpu.write(page, data, True)
+
+    for page in pages:
+        data = _page_data(ih, page, page_size)
+        if len(data) > 0 and bytes(cpu.read(page, len(data))) != data:
+            raise Exception(f'Verification failed for page {page:#010x}')
@@ -0,0 +1,81 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import os
+import json
+import shutil
+import hashlib
+import pathlib
+import logging
+from intelhex import IntelHex
+
+LOGGER = logging.getLogger(__name__)
+
+
+def hex_digest(hex_path):
+    """Hash of the data in a hex file, regardless of how the file is laid out."""
+    ih = IntelHex(str(hex_path))
+    digest = hashlib.sha256()
+
+    for (start, end) in ih.segments():
+        digest.update(start.to_bytes(4, 'little'))
+        digest.update(ih.tobinstr(start, end - 1))
+
+    return digest.hexdigest()
+
+
+class FlashState():
+    """Hash of the firmware last programmed on each (segger_id, core).
+
+    Stored as one file per core in `directory`, so that it survives between
+    runs. It is only a hint: the device still has to be checked, as it can have
+    been flashed by something else in the meantime.
+
+    A copy of the hex file is kept too: with `differential`, only the pages that
+    differ from it are flashed (see flash_diff.py).
+    """
+    def __init__(self, directory, differential=False):
+        self.directory = pathlib.Path(directory)
+        self.differential = differential
+
+    def _path(self, id, core):
+        return self.directory / f'{id}-{core}.json'
+
+    def image(self, id, core):
+        """Copy of the hex file last flashed on the core, if any."""
+        path = self.directory / f'{id}-{core}.hex'
+        return path if path.exists() else None
+
+    def get(self, id, core):
+        try:
+            with open(self._path(id, core), 'r') as stream:
+                return json.load(stream)['digest']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            LOGGER.warning(f'[{id}] ignoring flash state of {core} core: {e}')
+            return None
+
+    def set(self, id, core, digest, hex_path):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # The image first: the state is only valid once both are written
+        image_path = self.directory / f'{id}-{core}.hex'
+        shutil.copyfile(hex_path, image_path.with_suffix('.hex.tmp'))
+        os.replace(image_path.with_suffix('.hex.tmp'), image_path)
+
+        path = self._path(id, core)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as stream:
+            json.dump({'digest': digest, 'hex': str(hex_path)}, stream)
+        os.replace(tmp_path, path)
+
+    def forget(self, id, core):
+        """Drop the state, the image is kept: it is only used if the device
+        is checked to still have it."""
+        try:
+            os.remove(self._path(id, core))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""Fragmentation of the packets that don't fit in a single UART frame.
+
+Same protocol as nrf_rpc_uart. Frames carrying a fragment have
+`UARTHeader.FRAGMENT_FLAG` set in their length field, and start with a
+fragment header: kind, message ID, fragment index, and either the total
+length of the message (DATA) or a number of credits (CREDIT).
+
+A sender can only have `window` fragments in flight: each DATA fragment takes a
+credit, and the receiver gives it back with a CREDIT fragment once it has
+copied the fragment out of its buffers. A single fragmented message is in flight
+at a time, and the frames sent after it are held back until it is out, so that
+packets stay in order.
+"""
+import enum
+import struct
+import threading
+import logging
+import collections
+from targettest.uart_packet import UARTHeader
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FragmentKind(enum.IntEnum):
+    DATA = 0
+    CREDIT = 1
+
+
+class _Message():
+    __slots__ = ('body', 'msg_id', 'offset', 'index')
+
+    def __init__(self, body, msg_id):
+        self.body = body
+        self.msg_id = msg_id
+        self.offset = 0
+        self.index = 0
+
+
+class FragmentLink():
+    """Fragments the outgoing packets and reassembles the incoming ones.
+
+    `write` is called with whole UART frames, it must not block: it is called
+    from `send()` as well as from the RX path, when credits are received.
+
+    Packets whose body is longer than `max_frame_size` (the receiver's frame
+    buffer) are fragmented, the others are sent as-is.
+    """
+    _header = struct.Struct('<BBHI')
+
+    # Must match CONFIG_NRF_RPC_UART_FRAG_SIZE and CONFIG_NRF_RPC_UART_FRAG_WINDOW
+    FRAGMENT_SIZE = 512
+    WINDOW = 3
+
+    def __init__(self, write, max_frame_size=2048, fragment_size=FRAGMENT_SIZE, window=WINDOW):
+        self._write = write
+        self.max_frame_size = max_frame_size
+        self.fragment_size = fragment_size
+        self.window = window
+
+        self._cond = threading.Condition()
+        self._msg_id = 0
+
+        self.fragments_sent = 0
+        self.fragments_received = 0
+        self.messages_dropped = 0
+
+        self.reset()
+
+    def reset(self):
+        """Drop the messages in progress, e.g. because the peer has been reset."""
+        with self._cond:
+            self.credits = self.window
+            self._queue = collections.deque()
+            self._rx = None
+            self._cond.notify_all()
+
+    def _fragment_frame(self, kind, msg_id, index, value, data=b''):
+        return UARTHeader.frame(self._header.pack(kind, msg_id, index, value) + data,
+                                fragment=True)
+
+    def send(self, frame: bytes):
+        """Send a UART frame, fragmenting it if needed."""
+        with self._cond:
+            body_size = len(frame) - UARTHeader._size
+
+            if body_size > self.max_frame_size:
+                self._msg_id = (self._msg_id + 1) & 0xFF
+                body = memoryview(frame)[UARTHeader._size:]
+                self._queue.append(_Message(body, self._msg_id))
+
+            elif not self._queue:
+                self._write(frame)
+                return
+
+            else:
+                self._queue.append(frame)
+
+            self._pump()
+
+    def _pump(self):
+        # Has to be called with `_cond` held
+        queue = self._queue
+
+        while queue:
+            head = queue[0]
+
+            if not isinstance(head, _Message):
+                self._write(head)
+                queue.popleft()
+                continue
+
+            if self.credits == 0:
+                # Resumed once the receiver gives credits back
+                break
+
+            chunk = head.body[head.offset:head.offset + self.fragment_size]
+            self._write(self._fragment_frame(FragmentKind.DATA, head.msg_id, head.index,
+                                             len(head.body), chunk))
+            self.credits -= 1
+            self.fragments_sent += 1
+
+            head.offset += len(chunk)
+            head.index += 1
+            if head.offset == len(head.body):
+                queue.popleft()
+
+        if not queue:
+            self._cond.notify_all()
+
+    @property
+    def idle(self):
+        """True if no frame is held back."""
+        return not self._queue
+
+    def wait_idle(self, timeout=15):
+        """Block until all the frames held back have been passed to `write`."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self._queue, timeout):
+                raise TimeoutError(f'fragmented message stalled ({self.credits} credits)')
+
+    def handle_rx(self, data: bytes):
+        """Handle the payload of a fragment frame.
+
+        Returns the body of the reassembled packet once its last fragment is
+        received, else None.
+        """
+        if len(data) < self._header.size:
+            LOGGER.warning(f'fragment too short ({len(data)} bytes)')
+            return None
+
+        (kind, msg_id, index, value) = self._header.unpack_from(data)
+
+        if kind == FragmentKind.CREDIT:
+            with self._cond:
+                self.credits = min(self.credits + value, self.window)
+                self._pump()
+            return None
+
+        if kind != FragmentKind.DATA:
+            LOGGER.warning(f'unknown fragment kind {kind}')
+            return None
+
+        self.fragments_received += 1
+        chunk = memoryview(data)[self._header.size:]
+
+        with self._cond:
+            rx = self._rx
+            if index == 0:
+                if rx is not None:
+                    LOGGER.warning(f'message {rx.msg_id} interrupted by message {msg_id}')
+                    self.messages_dropped += 1
+
+                rx = _Message(bytearray(), msg_id)
+                self._rx = rx
+
+            elif rx is None or rx.msg_id != msg_id or rx.index != index:
+                LOGGER.warning(f'unexpected fragment {msg_id}:{index}, dropping message')
+                if rx is not None:
+                    self.messages_dropped += 1
+                self._rx = None
+                rx = None
+
+            if rx is not None:
+                rx.body += chunk
+                rx.index += 1
+
+            # The fragment has been consumed, give its credit back
+            self._write(self._fragment_frame(FragmentKind.CREDIT, msg_id, index, 1))
+
+            if rx is None or len(rx.body) < value:
+                return None
+
+            self._rx = None
+            if len(rx.body) > value:
+                LOGGER.warning(f'message {msg_id} longer than advertised, dropping it')
+                self.messages_dropped += 1
+                return None
+
+            return bytes(rx.body)
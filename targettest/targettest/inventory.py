@@ -0,0 +1,97 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import os
+import json
+import time
+import pathlib
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Inventory():
+    """Devices found by the previous discoveries, by J-Link serial number.
+
+    Getting the device family means connecting to the emulator, the serial
+    ports can be listed without it. An entry is only trusted if it is less than
+    `ttl` seconds old, and if the emulator still has the same serial ports, i.e.
+    it hasn't been plugged somewhere else.
+
+    Without `path`, nothing is stored.
+    """
+    VERSION = 1
+    TTL = 24 * 3600
+
+    def __init__(self, path=None, ttl=TTL):
+        self.path = pathlib.Path(path) if path is not None else None
+        self.ttl = ttl
+        self.entries = {}
+
+        if self.path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as stream:
+                content = json.load(stream)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            LOGGER.warning(f'ignoring device inventory {self.path}: {e}')
+            return
+
+        if content.get('version') != self.VERSION:
+            LOGGER.debug(f'ignoring device inventory {self.path}: version mismatch')
+            return
+
+        self.entries = {int(id): entry for (id, entry) in content['devices'].items()}
+
+    def save(self):
+        if self.path is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        content = {'version': self.VERSION,
+                   'devices': {str(id): entry for (id, entry) in self.entries.items()}}
+
+        # Written to another file first, so that a run that is interrupted
+        # doesn't leave a truncated inventory behind
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as stream:
+            json.dump(content, stream, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def sync(self, ports: dict):
+        """Update the inventory with the emulators currently connected and their
+        serial ports. Returns the IDs of those that have to be probed."""
+        now = time.time()
+        stale = []
+
+        for id in list(self.entries):
+            if id not in ports:
+                LOGGER.debug(f'[{id}] disconnected')
+                del self.entries[id]
+
+        for (id, id_ports) in ports.items():
+            entry = self.entries.get(id)
+            if entry is None:
+                LOGGER.debug(f'[{id}] new device')
+            elif entry['ports'] != id_ports:
+                LOGGER.debug(f'[{id}] moved from {entry["ports"]} to {id_ports}')
+            elif now - entry['probed'] > self.ttl:
+                LOGGER.debug(f'[{id}] inventory entry expired')
+            else:
+                continue
+
+            stale.append(id)
+
+        return stale
+
+    def add(self, id: int, family: str, ports: list):
+        self.entries[id] = {'family': family, 'ports': ports, 'probed': time.time()}
+
+    def forget(self, id: int):
+        self.entries.pop(id, None)
@@ -0,0 +1,133 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""Per-test archive of the device logs.
+
+For each test, the RTT log of each device and the data it exchanged with the
+host (wire trace) are streamed to gzip-compressed files as they are received:
+
+    <directory>/<test>/<device>.rtt.log.gz
+    <directory>/<test>/<device>.wire.log.gz
+
+`index.jsonl` has one record per file, with its position (`start`, `end`) in
+the device's stream for the whole session, so segments can be put back
+together.
+"""
+import re
+import gzip
+import json
+import time
+import pathlib
+import threading
+import logging
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Segment():
+    """Compressed file receiving one stream of one device during one test."""
+    def __init__(self, path: pathlib.Path, start=0):
+        self.path = path
+        self.start = start
+        self.size = 0
+
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+
+    def write(self, data: str):
+        with self._lock:
+            if self._file is None:
+                # Closed, the device keeps logging between tests
+                return
+
+            self._file.write(data)
+            self.size += len(data)
+
+    def trace(self, direction: str, data: bytes):
+        """Called by the UART channel with the data sent and received."""
+        self.write(f'{time.time():.6f} {direction} {data.hex(" ")}\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class DeviceSegment():
+    """Logs of a device during one test."""
+    def __init__(self, rtt: Segment, wire: Segment):
+        self.rtt = rtt
+        self.wire = wire
+
+    def trace(self, direction: str, data: bytes):
+        self.wire.trace(direction, data)
+
+
+class LogArchive():
+    # Lines of device log kept in the report
+    TAIL_LINES = 20
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Size of each (device, stream) so far
+        self._offsets = {}
+        self._index = open(self.directory / 'index.jsonl', 'a', encoding='utf-8')
+
+        LOGGER.info(f'Archiving device logs in {self.directory}')
+
+    def close(self):
+        self._index.close()
+
+    def _open(self, test_dir, device: str, stream: str):
+        start = self._offsets.get((device, stream), 0)
+        return Segment(test_dir / f'{device}.{stream}.log.gz', start)
+
+    def _record(self, test_id, device, stream, segment: Segment):
+        end = segment.start + segment.size
+        self._offsets[(device, stream)] = end
+
+        record = {'test': test_id, 'device': device, 'stream': stream,
+                  'path': str(segment.path.relative_to(self.directory)),
+                  'start': segment.start, 'end': end}
+        self._index.write(json.dumps(record) + '\n')
+        self._index.flush()
+
+    @contextmanager
+    def segment(self, request, devkit):
+        """Archive the logs of `devkit` for the duration of the test.
+
+        The test's report gets the path to the files, and the last lines of the
+        device log.
+        """
+        test_id = request.node.nodeid
+        test_dir = self.directory / re.sub(r'[^\w.-]+', '_', test_id)
+        test_dir.mkdir(parents=True, exist_ok=True)
+
+        device = re.sub(r'[^\w.-]+', '_', devkit.name)
+        logs = DeviceSegment(self._open(test_dir, device, 'rtt'),
+                             self._open(test_dir, device, 'wire'))
+        devkit.logs.sink = logs.rtt.write
+
+        try:
+            yield logs
+
+        finally:
+            devkit.logs.sink = None
+
+            for (stream, segment) in (('rtt', logs.rtt), ('wire', logs.wire)):
+                segment.close()
+                self._record(test_id, device, stream, segment)
+
+            # Reference only, the files have the whole log
+            request.node.user_properties.append((f'{device}_log', str(logs.rtt.path)))
+            request.node.user_properties.append((f'{device}_wire', str(logs.wire.path)))
+
+            tail = '\n'.join(devkit.logs.lines(since=devkit.logs.mark() - self.TAIL_LINES))
+            LOGGER.info(f'[{devkit.segger_id}] {devkit.name} logs: {logs.rtt.path}, '
+                        f'last lines:\n{tail}')
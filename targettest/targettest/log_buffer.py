@@ -0,0 +1,225 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+import re
+import time
+import tempfile
+import threading
+import logging
+import collections
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LogMatch(collections.namedtuple('LogMatch', ['index', 'line', 'match'])):
+    """Line of log matched by `LogBuffer.wait_for()`."""
+    __slots__ = ()
+
+    @property
+    def marker(self):
+        """Marker to only look at the lines after this one."""
+        return self.index + 1
+
+
+class LogBuffer():
+    """Device log, stored as a list of chunks.
+
+    Appending is linear in the size of the received data, unlike growing a
+    single string. Once the chunks held in memory go over `memory_limit`
+    characters, the oldest ones are moved to a temporary file in `spill_dir`.
+    Without `spill`, or if the file can't be written, they are dropped
+    instead and counted in `dropped`.
+
+    Received data is also split into lines, which are indexed by their number
+    since the last `clear()`. A marker is a line number: `mark()` returns the
+    number of the next line to be received. The most recent lines are kept in
+    the index, up to `memory_limit` characters.
+
+    If set, `sink` is called with the received data as well, e.g. to archive
+    it (see log_archive.py).
+    """
+    # Received data is joined into chunks of this size
+    CHUNK_SIZE = 64 * 1024
+    MEMORY_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, memory_limit=MEMORY_LIMIT, spill=True, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.sink = None
+
+        self._lock = threading.Condition()
+        self._spill_file = None
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        with self._lock:
+            self._chunks = collections.deque()
+            self._chunks_size = 0
+            # Not joined yet
+            self._tail = []
+            self._tail_size = 0
+
+            self.spilled = 0
+            self.dropped = 0
+
+            # Indexed lines, the first one is line number `_first_line`
+            self._lines = []
+            self._lines_size = 0
+            self._first_line = 0
+            # Start of the line being received
+            self._partial = []
+
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+    @property
+    def size(self):
+        """Number of characters received, including the dropped ones."""
+        return self.dropped + self.spilled + self._chunks_size + self._tail_size
+
+    def append(self, data: str):
+        if len(data) == 0:
+            return
+
+        with self._lock:
+            if self.sink is not None:
+                self.sink(data)
+
+            self._tail.append(data)
+            self._tail_size += len(data)
+
+            if self._tail_size >= self.CHUNK_SIZE:
+                self._flush_tail()
+
+                if self._chunks_size > self.memory_limit:
+                    self._evict()
+
+            self._partial.append(data)
+            if '\n' in data:
+                self._index_lines()
+                self._lock.notify_all()
+
+    def _index_lines(self):
+        lines = ''.join(self._partial).split('\n')
+        last = lines.pop()
+        self._partial = [last] if last else []
+
+        for line in lines:
+            line = line.rstrip('\r')
+            self._lines.append(line)
+            self._lines_size += len(line)
+
+        if self._lines_size > self.memory_limit:
+            # Drop the oldest half, so that trimming the list is amortized
+            count = len(self._lines) // 2
+            self._lines_size -= sum(len(line) for line in self._lines[:count])
+            del self._lines[:count]
+            self._first_line += count
+
+    def _flush_tail(self):
+        self._chunks.append(''.join(self._tail))
+        self._chunks_size += self._tail_size
+        self._tail = []
+        self._tail_size = 0
+
+    def _evict(self):
+        # Keep the newest chunks in memory, they are the most likely to be read
+        while self._chunks_size > self.memory_limit and len(self._chunks) > 1:
+            chunk = self._chunks.popleft()
+            self._chunks_size -= len(chunk)
+
+            if self._write_spill(chunk):
+                self.spilled += len(chunk)
+            else:
+                self.dropped += len(chunk)
+
+    def _write_spill(self, chunk):
+        if not self.spill:
+            return False
+
+        try:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(mode='w+', encoding='utf-8',
+                                                          dir=self.spill_dir,
+                                                          prefix='rtt-', suffix='.log')
+            self._spill_file.write(chunk)
+            return True
+
+        except OSError as e:
+            LOGGER.error(f'unable to spill the device log to disk, dropping it: {e}')
+            self.spill = False
+            return False
+
+    @property
+    def line_count(self):
+        """Number of complete lines received."""
+        return self._first_line + len(self._lines)
+
+    def mark(self):
+        """Marker for the lines received from now on."""
+        with self._lock:
+            return self.line_count
+
+    def lines(self, since=0):
+        """Lines received since `since`, that are still indexed."""
+        with self._lock:
+            return self._lines[max(since - self._first_line, 0):]
+
+    def _search(self, search, start):
+        for index in range(max(start, self._first_line), self.line_count):
+            line = self._lines[index - self._first_line]
+            match = search(line)
+            if match is not None:
+                return LogMatch(index, line, match)
+
+        return None
+
+    def wait_for(self, pattern, timeout=5, since=0):
+        """Wait for a line matching the `pattern` regex, received after the
+        `since` marker. Raises TimeoutError."""
+        search = re.compile(pattern).search
+        end_time = time.monotonic() + timeout
+
+        with self._lock:
+            if since < self._first_line:
+                LOGGER.debug(f'lines {since} to {self._first_line} are not indexed anymore')
+
+            # Only the lines received since the last search are examined
+            start = since
+            while True:
+                found = self._search(search, start)
+                if found is not None:
+                    return found
+
+                start = self.line_count
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'no log line matching {pattern!r} after line {since}')
+
+                self._lock.wait(remaining)
+
+    def getvalue(self):
+        """The whole log, minus the dropped data."""
+        with self._lock:
+            parts = []
+            if self._spill_file is not None:
+                self._spill_file.flush()
+                self._spill_file.seek(0)
+                parts.append(self._spill_file.read())
+                # Appending has to resume at the end
+                self._spill_file.seek(0, 2)
+
+            parts.extend(self._chunks)
+            parts.extend(self._tail)
+
+        return ''.join(parts)
+
+    def close(self):
+        self.clear()
@@ -4,13 +4,21 @@
 # SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
 #
 import time
+import asyncio
 import pathlib
+import importlib.util
+import multiprocessing
 import logging
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from intelhex import IntelHex
-from targettest.devkit import Devkit, flash, reset
+from targettest.devkit import (Devkit, reset, flash_cores, flash_cores_process,
+                               SESSIONS)
 from targettest.uart_channel import UARTRPCChannel
 from targettest.rpc_channel import RPCChannel
+from targettest.async_uart_channel import AsyncUARTRPCChannel
+from targettest.async_rpc_channel import AsyncRPCChannel
+from targettest.sim import SimulatedDevkit
 
 LOGGER = logging.getLogger(__name__)
 
@@ -60,43 +68,156 @@ def get_fw_path(suite, board, network_core=None):
 
     return fw_hex
 
-@contextmanager
-def FlashedDevice(request, family='NRF53', id=None, board='nrf5340dk_nrf5340_cpuapp', name=None, flash_device=True, emu=True):
-    # Select HW device
-    dev = get_available_dk(family, id)
-    assert dev is not None, f'Hardware device not found'
+def get_sim_path(suite):
+    """Find the simulated firmware for the calling test suite"""
+    script_path = pathlib.Path(getattr(suite.module, "__file__"))
+    sim_path = script_path.parent / 'fw' / 'sim.py'
 
-    if family is not None:
-        family = family.upper()
+    assert sim_path.exists(), "Missing simulated firmware"
 
-    if name is not None:
-        dev.name = name
+    return sim_path
 
-    if flash_device:
-        # Flash device with test FW & reset it
-        if family == 'NRF53':
-            # Flash the network core first
-            fw_hex = get_fw_path(request, board, network_core=True)
-            flash(dev.segger_id, dev.family, fw_hex, core='NET')
+def load_sim_firmware(suite, devices: dict):
+    """Run the simulated firmware's `setup(devices)` on the simulated devices"""
+    sim_path = get_sim_path(suite)
 
-        fw_hex = get_fw_path(request, board)
-        flash(dev.segger_id, dev.family, fw_hex)
+    spec = importlib.util.spec_from_file_location(f'sim_{sim_path.parent.parent.name}', sim_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
 
-        reset(dev.segger_id, dev.family)
+    module.setup(devices)
+
+sim_id = 0
+@contextmanager
+def SimulatedDevice(request, family='NRF53', name=None):
+    """Stand-in for FlashedDevice that doesn't require any hardware.
 
-    dev.open(open_emu=emu)
+    Call `load_sim_firmware()` on the devices to make them do something useful.
+    """
+    global sim_id
+    sim_id += 1
+
+    if name is None:
+        name = f'sim-{sim_id}'
+
+    dev = SimulatedDevkit(sim_id, family, name)
+    dev.open()
 
     yield dev
 
     dev.close()
 
+def get_flash_steps(request, family, board):
+    """The (core, hex file) to flash, in order."""
+    steps = []
+    if family == 'NRF53':
+        # Flash the network core first
+        steps.append(('NET', get_fw_path(request, board, network_core=True)))
+
+    steps.append(('APP', get_fw_path(request, board)))
+
+    return steps
+
+def report_flash(dev: Devkit, results):
+    for (core, flashed, duration) in results:
+        action = 'flashed' if flashed else 'already flashed'
+        LOGGER.info(f'[{dev.segger_id}] {dev.name} {core} core {action} in {duration:.1f}s')
+
+def flash_devices(jobs: list, flash_state=None):
+    """Flash the devices in parallel. `jobs` are (devkit, steps) tuples.
+
+    Each device is flashed by a separate process, with its own J-Link session
+    and nrfjprog library state, so that the slow, blocking nrfjprog calls of
+    the devices overlap. The steps of a device are done in order.
+    """
+    start = time.monotonic()
+
+    if len(jobs) == 1:
+        (dev, steps) = jobs[0]
+        report_flash(dev, flash_cores(dev.segger_id, dev.family, steps, flash_state))
+        return
+
+    for (dev, _) in jobs:
+        # The worker processes connect to the emulators themselves
+        SESSIONS.close(dev.segger_id)
+
+    LOGGER.info(f'Flashing {len(jobs)} devices...')
+
+    # Not forked: the child processes must not inherit the J-Link sessions
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(jobs), mp_context=context) as pool:
+        futures = {pool.submit(flash_cores_process, dev.segger_id, dev.family, steps,
+                               flash_state): dev
+                   for (dev, steps) in jobs}
+
+        for future in as_completed(futures):
+            dev = futures[future]
+            try:
+                report_flash(dev, future.result())
+            except Exception as e:
+                LOGGER.error(f'[{dev.segger_id}] {dev.name} flashing failed: {e!r}')
+                raise
+
+    LOGGER.info(f'Flashed {len(jobs)} devices in {time.monotonic() - start:.1f}s')
+
+@contextmanager
+def FlashedDevices(request, configs: list, flash_device=True, emu=True, flash_state=None):
+    """Same as FlashedDevice, for several devices, which are flashed in
+    parallel. `configs` are dicts of FlashedDevice's arguments (family, id,
+    board, name). Yields the devices, in the same order."""
+    selected = []
+    try:
+        for config in configs:
+            family = config.get('family', 'NRF53').upper()
+
+            # Select HW device
+            dev = get_available_dk(family, config.get('id'))
+            assert dev is not None, f'Hardware device not found'
+
+            # Reserved, so it isn't selected again for the next configs
+            dev.in_use = True
+            selected.append(dev)
+
+            if config.get('name') is not None:
+                dev.name = config['name']
+
+        if flash_device:
+            # Flash devices with test FW & reset them
+            jobs = [(dev, get_flash_steps(request, dev.family,
+                                          config.get('board', 'nrf5340dk_nrf5340_cpuapp')))
+                    for (dev, config) in zip(selected, configs)]
+            flash_devices(jobs, flash_state)
+
+            for dev in selected:
+                reset(dev.segger_id, dev.family)
+
+        for dev in selected:
+            dev.open(open_emu=emu)
+
+            if not emu:
+                # Leave the emulator to the debugger
+                SESSIONS.close(dev.segger_id)
+
+        yield selected
+
+    finally:
+        for dev in selected:
+            dev.close()
 
 @contextmanager
-def RPCDevice(device: Devkit, group='nrf_pytest'):
+def FlashedDevice(request, family='NRF53', id=None, board='nrf5340dk_nrf5340_cpuapp', name=None, flash_device=True, emu=True, flash_state=None):
+    config = {'family': family, 'id': id, 'board': board, 'name': name}
+
+    with FlashedDevices(request, [config], flash_device, emu, flash_state) as devices:
+        yield devices[0]
+
+
+@contextmanager
+def RPCDevice(device: Devkit, group='nrf_pytest', codecs=None, trace=None):
     try:
         # Manage RPC transport
-        uart = UARTRPCChannel(port=device.port)
-        channel = RPCChannel(uart, group_name=group)
+        uart = UARTRPCChannel(port=device.port, trace=trace)
+        channel = RPCChannel(uart, group_name=group, codecs=codecs)
         uart.open()
         LOGGER.debug('Wait for RPC ready')
         # Start receiving bytes
@@ -121,10 +242,44 @@ def RPCDevice(device: Devkit, group='nrf_pytest'):
     finally:
         LOGGER.info(f'[{device.port}] closing channel')
         uart.close()
+        channel.close()
         device.stop_logging()
         device.halt()
 
 
+@asynccontextmanager
+async def AsyncRPCDevice(device: Devkit, group='nrf_pytest', codecs=None, trace=None):
+    """Same as RPCDevice, but yields an AsyncRPCChannel serviced by the
+    running event loop."""
+    loop = asyncio.get_running_loop()
+    try:
+        # Manage RPC transport
+        uart = AsyncUARTRPCChannel(port=device.port, trace=trace)
+        channel = AsyncRPCChannel(uart, group_name=group, codecs=codecs)
+        uart.open()
+        LOGGER.debug('Wait for RPC ready')
+        # The emulator calls are blocking, keep them off the event loop
+        await loop.run_in_executor(None, device.reset)
+        await loop.run_in_executor(None, device.start_logging)
+
+        # Wait until we have received the handshake/init packet
+        await channel.wait_established(timeout=5)
+
+        # Wait for the READY event (sent from main)
+        event = await channel.get_evt()
+        assert event.opcode == 0x01
+        LOGGER.info(f'[{device.port}] channel ready')
+
+        yield channel
+
+    finally:
+        LOGGER.info(f'[{device.port}] closing channel')
+        uart.close()
+        channel.close()
+        await loop.run_in_executor(None, device.stop_logging)
+        await loop.run_in_executor(None, device.halt)
+
+
 class TestDevice():
     """Convenience class to group devkit and rpc objects for further usage in
     the test case."""
@@ -4,17 +4,62 @@
 # SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
 #
 import time
-import queue
 import logging
+import threading
+import collections
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from targettest.abstract_transport import PacketTransport
-from targettest.cbor import CBORPayload
+from targettest.codec import CodecRegistry
+from targettest.dispatch import OrderedDispatcher
+from targettest.event_queue import EventQueue, Overflow, Subscription
 from targettest.rpc_packet import RPCPacket, RPCPacketType
 
 LOGGER = logging.getLogger(__name__)
 
 
+class RPCRequest(Future):
+    """In-flight CMD or EVT, resolved with the matching RSP or ACK packet.
+
+    Fails with TimeoutError once its deadline has passed.
+    """
+    def __init__(self, packet_type: RPCPacketType, opcode: int, timeout):
+        Future.__init__(self)
+        self.packet_type = packet_type
+        self.opcode = opcode
+        self.deadline = time.monotonic() + timeout
+        self.expired = False
+
+    def __repr__(self):
+        return f'RPCRequest {self.packet_type.name} {self.opcode:02x}'
+
+    def result(self, timeout=None):
+        """Wait for the response, by default until the request's deadline."""
+        if timeout is None:
+            timeout = max(0, self.deadline - time.monotonic())
+
+        return Future.result(self, timeout)
+
+
 class RPCChannel():
-    def __init__(self, transport: PacketTransport, default_packet_handler=None, group_name=None):
+    """nRF RPC session with a device.
+
+    Up to `window` commands and events can be in flight at the same time (see
+    `cmd_async` and `evt_async`). Responses are matched in order: RSPs against
+    the oldest command, ACKs against the oldest event with the same opcode.
+    Requests that timed out are skipped.
+
+    Received events go to the subscriptions they match (see `subscribe`), or,
+    if there are none, to `events` until they're pulled with `get_evt`.
+
+    The transport's RX thread only completes requests. Events and packets for
+    the registered handlers are handled on `executor`, in order for a given
+    opcode. By default, a single worker thread handles everything in order.
+
+    The `*_cbor` methods and subscriptions encode and decode payloads with the
+    schemas registered in `codecs` (see codec.py), if any.
+    """
+    def __init__(self, transport: PacketTransport, default_packet_handler=None, group_name=None,
+                 window=1, executor=None, codecs=None):
         # A valid transport has to be initialized first
         self.transport = transport
         self.transport.packet_handler = self.handler
@@ -24,9 +69,20 @@ class RPCChannel():
         self.established = False
 
         # Handlers
-        self.events = queue.Queue()
+        self.events = EventQueue()
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
         self.default_packet_handler = default_packet_handler
         self.handler_lut = {item.value: {} for item in RPCPacketType}
+        self.codecs = codecs if codecs is not None else CodecRegistry()
+        self.dispatcher = OrderedDispatcher(executor, name=f'rpc-{group_name}')
+
+        # In-flight requests, completed by the RX thread
+        self.window = window
+        self._completion = threading.Condition()
+        self._inflight = 0
+        self._pending_rsp = collections.deque()
+        self._pending_ack = collections.defaultdict(collections.deque)
 
     def handler_exists(self, packet: RPCPacket):
         return packet.opcode in self.handler_lut[packet.packet_type]
@@ -35,35 +91,28 @@ class RPCChannel():
         return self.handler_lut[packet.packet_type][packet.opcode]
 
     def handler(self, packet: RPCPacket):
+        # Called from the transport's RX thread, has to return quickly
         LOGGER.debug(f'Handling {packet}')
-        # TODO: terminate session on ERR packets
-        # Call opcode handler if registered, else call default handler
         if packet.packet_type == RPCPacketType.INIT:
-            # Check the INIT packet is for the test system
-            assert packet.payload == b'\x00' + self.group_name.encode()
-            self.remote_gid = packet.gid_src
+            self.handle_init(packet)
 
-            self.transport.clear_buffers()
-            self.clear_events()
+        elif packet.packet_type == RPCPacketType.ACK:
+            self.handle_ack(packet)
 
-            # Mark channel as usable and send INIT response
-            self.send_init()
-            self.established = True
-            LOGGER.debug(f'[{self.transport}] channel established')
+        elif packet.packet_type == RPCPacketType.RSP:
+            self.handle_rsp(packet)
 
-        elif packet.packet_type == RPCPacketType.EVT:
-            self.events.put(packet)
-            self.ack(packet.opcode)
+        else:
+            self.defer(packet)
 
-        elif packet.packet_type == RPCPacketType.ACK:
-            (_, sent_opcode) = self._ack
-            assert packet.opcode == sent_opcode
-            self._ack = (packet, packet.opcode)
+    def defer(self, packet: RPCPacket):
+        self.dispatcher.submit(packet.opcode, self.dispatch, packet)
 
-        elif packet.packet_type == RPCPacketType.RSP:
-            # We just assume only one command can be in-flight at a time
-            # Should be enough for testing, can be extended later.
-            self._rsp = packet
+    def dispatch(self, packet: RPCPacket):
+        # TODO: terminate session on ERR packets
+        # Call opcode handler if registered, else call default handler
+        if packet.packet_type == RPCPacketType.EVT:
+            self.handle_evt(packet)
 
         elif self.handler_exists(packet):
             self.lookup(packet)(self, packet)
@@ -74,42 +123,226 @@ class RPCChannel():
         else:
             LOGGER.error(f'[{self.transport}] unhandled packet {packet}')
 
+    def handle_init(self, packet: RPCPacket):
+        # Check the INIT packet is for the test system
+        assert packet.payload == b'\x00' + self.group_name.encode()
+        self.remote_gid = packet.gid_src
+
+        self.transport.clear_buffers()
+        self.dispatcher.clear()
+        self.clear_events()
+        self.cancel_requests()
+
+        # Mark channel as usable and send INIT response
+        self.send_init()
+        self.established = True
+        LOGGER.debug(f'[{self.transport}] channel established')
+
+    def handle_evt(self, packet: RPCPacket):
+        if not self._publish(packet):
+            self.events.put(packet)
+        self.ack(packet.opcode)
+
+    def _publish(self, packet: RPCPacket):
+        # Returns True if the event went to at least one subscription
+        subscriptions = self._subscriptions
+        matched = []
+        for subscription in subscriptions:
+            try:
+                if subscription.matches(packet):
+                    matched.append(subscription)
+            except Exception:
+                LOGGER.exception(f'[{self.transport}] {subscription}: predicate failed on {packet}')
+
+        if any(subscription.closed for subscription in subscriptions):
+            with self._subscriptions_lock:
+                self._subscriptions = [subscription for subscription in self._subscriptions
+                                       if not subscription.closed]
+
+        if len(matched) == 0:
+            return False
+
+        payload = None
+        if any(subscription.decode for subscription in matched):
+            try:
+                payload = self.codecs.decode(packet.opcode, packet.payload)
+            except Exception:
+                LOGGER.exception(f'[{self.transport}] unable to decode {packet}')
+
+        for subscription in matched:
+            subscription.deliver(packet, payload if subscription.decode else None)
+
+        return True
+
+    def handle_ack(self, packet: RPCPacket):
+        self._complete(self._pending_ack[packet.opcode], packet)
+
+    def handle_rsp(self, packet: RPCPacket):
+        # nRF RPC handles commands in order
+        self._complete(self._pending_rsp, packet)
+
+    def _complete(self, pending: collections.deque, packet: RPCPacket):
+        with self._completion:
+            if len(pending) == 0:
+                LOGGER.error(f'[{self.transport}] unexpected {packet}')
+                return
+
+            # Expired requests either lost their response or get it late. As
+            # soon as a newer request is pending, the response goes to it:
+            # otherwise a single lost frame would make all the following
+            # requests time out.
+            request = next((request for request in pending if not request.expired), None)
+            if request is None:
+                # Late response, the request's slot has already been freed
+                pending.popleft()
+                LOGGER.debug(f'[{self.transport}] dropping late {packet}')
+                return
+
+            while pending.popleft() is not request:
+                LOGGER.debug(f'[{self.transport}] {packet}: skipping expired request')
+
+            self._inflight -= 1
+            request.set_result(packet)
+            self._completion.notify_all()
+
+    def _expire(self, request: RPCRequest, exception=None):
+        # Has to be called with `_completion` held. The request is kept in its
+        # pending queue, so that a late response is dropped if no newer
+        # request is waiting for it (see `_complete`).
+        request.expired = True
+        self._inflight -= 1
+
+        if exception is None:
+            exception = TimeoutError(f'{request} timed out')
+        request.set_exception(exception)
+        self._completion.notify_all()
+
+    def _pending_requests(self):
+        for pending in [self._pending_rsp, *self._pending_ack.values()]:
+            for request in pending:
+                if not request.expired:
+                    yield request
+
+    def _expire_overdue(self):
+        now = time.monotonic()
+        for request in list(self._pending_requests()):
+            if request.deadline <= now:
+                self._expire(request)
+
+    def cancel_requests(self):
+        """Fail all in-flight requests, e.g. because the device has been reset."""
+        with self._completion:
+            for request in list(self._pending_requests()):
+                self._expire(request, ConnectionResetError(f'{request} cancelled'))
+
+            self._pending_rsp.clear()
+            self._pending_ack.clear()
+
+    def _submit(self, packet_type: RPCPacketType, opcode: int, data: bytes, timeout):
+        request = RPCRequest(packet_type, opcode, timeout)
+        packet = self.make_packet(packet_type, opcode, data)
+
+        # Can't be cancelled from now on, only completed or expired
+        request.set_running_or_notify_cancel()
+
+        with self._completion:
+            # Wait for a free slot in the window
+            while self._inflight >= self.window:
+                self._expire_overdue()
+                if self._inflight < self.window:
+                    break
+
+                now = time.monotonic()
+                if now >= request.deadline:
+                    raise TimeoutError(f'{request}: no free slot in the request window')
+
+                # Wake up when the next in-flight request expires at the latest
+                deadline = min([request.deadline] +
+                               [pending.deadline for pending in self._pending_requests()])
+                self._completion.wait(deadline - now)
+
+            self._inflight += 1
+            if packet_type == RPCPacketType.CMD:
+                self._pending_rsp.append(request)
+            else:
+                self._pending_ack[opcode].append(request)
+
+            # Sent with the lock held, so that requests go out in the order
+            # they were registered in. The transport only queues the data.
+            self.transport.send(packet.raw)
+
+        return request
+
+    def wait(self, request: RPCRequest):
+        """Wait until the request's deadline and return the response packet.
+
+        Raises TimeoutError if it didn't arrive in time.
+        """
+        try:
+            return request.result()
+        except FutureTimeoutError:
+            pass
+
+        with self._completion:
+            if not request.done():
+                self._expire(request)
+
+        return request.result(0)
+
     def register_packet(self, packet_type: RPCPacketType, opcode: int, packet_handler):
         self.handler_lut[packet_type][opcode] = packet_handler
 
+    def make_packet(self, packet_type: RPCPacketType, opcode: int, data: bytes=b''):
+        return RPCPacket(packet_type, opcode,
+                         src=0, dst=0xFF,
+                         gid_src=self.remote_gid, gid_dst=self.remote_gid,
+                         payload=data)
+
     def ack(self, opcode: int):
-        packet = RPCPacket(RPCPacketType.ACK, opcode,
-                           src=0, dst=0xFF,
-                           gid_src=self.remote_gid, gid_dst=self.remote_gid,
-                           payload=b'')
+        packet = self.make_packet(RPCPacketType.ACK, opcode)
 
         self.transport.send(packet.raw)
 
+    def evt_async(self, opcode: int, data: bytes=b'', timeout=5):
+        """Send an event without waiting for its ACK.
+
+        Returns an RPCRequest, resolved with the ACK packet. Blocks if the
+        request window is full.
+        """
+        return self._submit(RPCPacketType.EVT, opcode, data, timeout)
+
     def evt(self, opcode: int, data: bytes=b'', timeout=5):
-        packet = RPCPacket(RPCPacketType.EVT, opcode,
-                           src=0, dst=0xFF,
-                           gid_src=self.remote_gid, gid_dst=self.remote_gid,
-                           payload=data)
-        self._ack = (None, opcode)
+        request = self.evt_async(opcode, data, timeout)
 
-        self.transport.send(packet.raw)
+        try:
+            self.wait(request)
+        except (TimeoutError, FutureTimeoutError):
+            raise Exception('Async command timeout')
 
-        end_time = time.monotonic() + timeout
-        while self._ack[0] is None:
-            time.sleep(.01)
-            if time.monotonic() > end_time:
-                raise Exception('Async command timeout')
+        return opcode
 
-        # Return packet containing the ACK
-        return self._ack[1]
+    def encode_params(self, opcode: int, data=None):
+        """Payload of the `*_cbor` methods, shared with AsyncRPCChannel."""
+        if data is None:
+            return b''
+
+        payload = self.codecs.encode(opcode, data)
+        LOGGER.debug(f'encoded payload: {payload.hex(" ")}')
+        return payload
+
+    def decode_result(self, opcode: int, rsp: RPCPacket):
+        LOGGER.debug(f'decoded payload: {rsp.payload.hex(" ")}')
+        return self.codecs.decode_result(opcode, rsp.payload)
+
+    def decoded_predicate(self, predicate):
+        """Predicate on the raw event, from one on its decoded payload."""
+        if predicate is None:
+            return None
+
+        return lambda evt: predicate(self.codecs.decode(evt.opcode, evt.payload))
 
     def evt_cbor(self, opcode: int, data=None, timeout=5):
-        if data is not None:
-            payload = CBORPayload(data).encoded
-            LOGGER.debug(f'encoded payload: {payload.hex(" ")}')
-            self.evt(opcode, payload, timeout=timeout)
-        else:
-            self.evt(opcode, timeout=timeout)
+        self.evt(opcode, self.encode_params(opcode, data), timeout=timeout)
 
     def cmd(self, opcode: int, data: bytes=b'', timeout=5):
         # WARNING:
@@ -121,51 +354,83 @@ class RPCChannel():
         # If commands (sync) are used, nRF RPC will get confused, being called
         # from an existing RPC context (UART in this case) and will try to send
         # the command over IPC, but using the wrong IDs, resulting in a deadlock.
-        packet = RPCPacket(RPCPacketType.CMD, opcode,
-                           src=0, dst=0xFF,
-                           gid_src=self.remote_gid, gid_dst=self.remote_gid,
-                           payload=data)
-        self._rsp = None
+        request = self.cmd_async(opcode, data, timeout)
 
-        self.transport.send(packet.raw)
+        try:
+            return self.wait(request)
+        except (TimeoutError, FutureTimeoutError):
+            raise Exception('Command timeout')
 
-        end_time = time.monotonic() + timeout
-        while self._rsp is None:
-            time.sleep(.01)
-            if time.monotonic() > end_time:
-                raise Exception('Command timeout')
+    def cmd_async(self, opcode: int, data: bytes=b'', timeout=5):
+        """Send a command without waiting for its response.
 
-        return self._rsp
+        Returns an RPCRequest, resolved with the RSP packet. Blocks if the
+        request window is full. See the warning in `cmd`.
+        """
+        return self._submit(RPCPacketType.CMD, opcode, data, timeout)
 
     def cmd_cbor(self, opcode: int, data=None, timeout=5):
-        if data is not None:
-            payload = CBORPayload(data).encoded
-            LOGGER.debug(f'encoded payload: {payload.hex(" ")}')
-            rsp = self.cmd(opcode, payload, timeout=timeout)
-        else:
-            rsp = self.cmd(opcode, timeout=timeout)
+        rsp = self.cmd(opcode, self.encode_params(opcode, data), timeout=timeout)
 
-        LOGGER.debug(f'decoded payload: {rsp.payload.hex(" ")}')
-        return CBORPayload.read(rsp.payload).objects
+        return self.decode_result(opcode, rsp)
+
+    def subscribe(self, opcode=None, callback=None, predicate=None,
+                  maxsize=1000, overflow=Overflow.BLOCK, decode=True):
+        """Receive the events with `opcode` and/or matching `predicate` (called
+        with the raw event) through a Subscription instead of `get_evt`.
+
+        With a callback, it is called with `(packet, payload)` for each event,
+        from the channel's executor. Otherwise, iterate over the
+        returned subscription, which stores up to `maxsize` events and applies
+        `overflow` when full. Events are CBOR-decoded unless `decode` is False.
+
+        Each event goes to all the subscriptions it matches. Use the returned
+        subscription as a context manager, or call `unsubscribe()`, to stop.
+        """
+        subscription = Subscription(opcode, predicate, callback, maxsize, overflow, decode)
+
+        with self._subscriptions_lock:
+            self._subscriptions = self._subscriptions + [subscription]
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.close()
+
+        with self._subscriptions_lock:
+            self._subscriptions = [item for item in self._subscriptions
+                                   if item is not subscription]
 
     def clear_events(self):
-        while not self.events.empty():
-            self.events.get()
+        self.events.clear()
+
+    def close(self):
+        """Stop handling packets. Doesn't close the transport."""
+        for subscription in self._subscriptions:
+            # Unblocks the executor if it is waiting on a full subscription
+            subscription.close()
+
+        self.dispatcher.close()
+        self.cancel_requests()
 
-    def get_evt(self, opcode=None, timeout=5):
-        if opcode is None:
-            return self.events.get(timeout=timeout)
+    def get_evt(self, opcode=None, timeout=5, predicate=None):
+        """Get the oldest event, or the oldest one with `opcode`.
 
-        # TODO: add filtering by opcode
-        return None
+        If `predicate` is given, only return an event for which
+        `predicate(packet)` is true. Events that are skipped stay queued.
+        Raises queue.Empty on timeout.
+        """
+        return self.events.get(opcode, predicate, timeout)
 
-    def get_evt_cbor(self, opcode=None, timeout=5):
-        evt = self.get_evt(opcode, timeout)
+    def get_evt_cbor(self, opcode=None, timeout=5, predicate=None):
+        """Same as get_evt(), but `predicate` is called with the decoded payload.
 
-        if evt is None:
-            return (evt, None)
+        E.g. to wait for the scan report of a given device:
+            get_evt_cbor(BT_SCAN_REPORT, predicate=lambda report: report[0] == addr)
+        """
+        evt = self.get_evt(opcode, timeout, self.decoded_predicate(predicate))
 
-        return (evt, CBORPayload.read(evt.payload).objects[0])
+        return (evt, self.codecs.decode(evt.opcode, evt.payload))
 
     def send_init(self):
         # Isn't encoded with CBOR
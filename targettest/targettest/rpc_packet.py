@@ -5,7 +5,7 @@
 #
 import enum
 import struct
-from targettest.uart_packet import UARTPacket
+from targettest.uart_packet import UARTHeader, UARTPacket
 
 
 class RPCPacketType(enum.IntEnum):
@@ -17,9 +17,24 @@ class RPCPacketType(enum.IntEnum):
     CMD = 0x80
 
 
+# For decoding without going through RPCPacketType()
+_PACKET_TYPES = {item.value: item for item in RPCPacketType}
+
+
 class RPCPacket():
+    """nRF RPC packet.
+
+    Received packets are decoded in one pass from the UART frame, the UART
+    encapsulation (`raw`) is only built when the packet is sent.
+    """
+    __slots__ = ('packet_type', 'opcode', 'src', 'dst', 'gid_src', 'gid_dst', 'payload', '_raw')
+
     _format = '<BBBBB'
     _size = struct.calcsize(_format)
+    _struct = struct.Struct(_format)
+
+    # UART header and RPC header, as received
+    _frame_struct = struct.Struct(UARTHeader._format + _format[1:])
 
     # Header: SRC + type, ID, DST, GID SRC, GID DST
     def __init__(self,
@@ -33,16 +48,7 @@ class RPCPacket():
         self.gid_src = gid_src
         self.gid_dst = gid_dst
         self.payload = payload
-        self.header = struct.pack(self._format,
-                                  packet_type | src,
-                                  opcode,
-                                  dst,
-                                  gid_src,
-                                  gid_dst)
-
-        # Build whole packet
-        self.packet = UARTPacket(self.header + self.payload)
-        self.raw = self.packet.raw
+        self._raw = None
 
     def __repr__(self):
         return '{} {:02x} LEN {} DATA {}'.format(
@@ -52,24 +58,79 @@ class RPCPacket():
             self.payload.hex(' ')
         )
 
-    @classmethod
-    def unpack(cls, packet: bytes):
-        payload = UARTPacket.unpack(packet).payload
+    @property
+    def header(self):
+        return self._struct.pack(self.packet_type | self.src,
+                                 self.opcode,
+                                 self.dst,
+                                 self.gid_src,
+                                 self.gid_dst)
 
-        # Separate RPC cmd/evt payload from RPC header
-        raw_header = payload[:cls._size]
-        payload = payload[cls._size:]
+    @property
+    def packet(self):
+        return UARTPacket(self.header + self.payload)
 
-        (packet_type,
-         opcode,
-         dst,
-         gid_src,
-         gid_dst) = struct.unpack(cls._format, raw_header)
+    @property
+    def raw(self):
+        # Whole packet, with the UART encapsulation
+        if self._raw is None:
+            self._raw = UARTHeader.frame(self.header + self.payload)
 
+        return self._raw
+
+    @classmethod
+    def _make(cls, packet_type, opcode, dst, gid_src, gid_dst, payload):
         if packet_type & RPCPacketType.CMD:
             src = packet_type & 0x7F
             packet_type = RPCPacketType.CMD
         else:
             src = 0
+            try:
+                packet_type = _PACKET_TYPES[packet_type]
+            except KeyError:
+                packet_type = RPCPacketType(packet_type)
+
+        # Skips the checks in __init__(), the values come from the wire
+        packet = cls.__new__(cls)
+        packet.packet_type = packet_type
+        packet.opcode = opcode
+        packet.src = src
+        packet.dst = dst
+        packet.gid_src = gid_src
+        packet.gid_dst = gid_dst
+        packet.payload = payload
+        packet._raw = None
 
-        return RPCPacket(packet_type, opcode, src, dst, gid_src, gid_dst, payload)
+        return packet
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Decode the UART frame starting at `offset` in `buf`.
+
+        Only the payload is copied out of the buffer. The frame is assumed to
+        be complete and valid (see UARTFramer).
+        """
+        (_, length, _,
+         packet_type,
+         opcode,
+         dst,
+         gid_src,
+         gid_dst) = cls._frame_struct.unpack_from(buf, offset)
+
+        start = offset + cls._frame_struct.size
+        end = offset + UARTHeader._size + length
+        with memoryview(buf) as view:
+            payload = bytes(view[start:end])
+
+        return cls._make(packet_type, opcode, dst, gid_src, gid_dst, payload)
+
+    @classmethod
+    def unpack_body(cls, body: bytes):
+        """Decode a packet without its UART header, e.g. a reassembled one."""
+        fields = cls._struct.unpack_from(body)
+        return cls._make(*fields, bytes(body[cls._size:]))
+
+    @classmethod
+    def unpack(cls, packet: bytes):
+        # Called on the whole frame, containing the UART header too
+        return cls.unpack_from(packet)
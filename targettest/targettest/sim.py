@@ -0,0 +1,301 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+"""In-process stand-in for a device running nRF RPC over UART.
+
+`RPCPeer` speaks the same UART framing and nRF RPC packet flow as the firmware
+(INIT handshake, EVT/ACK, CMD/RSP) over a file descriptor. It can either sit
+behind a pty, which the host opens like a real serial port, or behind a
+`LoopbackTransport`.
+"""
+import os
+import pty
+import tty
+import select
+import socket
+import threading
+import time
+import logging
+from targettest.abstract_transport import PacketTransport
+from targettest.cbor import CBORPayload
+from targettest.devkit import Devkit
+from targettest.fragment import FragmentLink
+from targettest.rpc_packet import RPCPacket, RPCPacketType
+from targettest.uart_channel import UARTFramer, UARTWriter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RPCPeer(threading.Thread):
+    """Simulated nRF RPC device.
+
+    Handlers are registered per opcode, and called from the peer's thread:
+    - EVT handlers: `handler(peer, packet)`, the EVT is ACKed once they return.
+    - CMD handlers: `handler(peer, packet)`, the return value is CBOR-encoded and
+      sent back in the RSP.
+    The boot handler is called once the INIT handshake is complete. It should
+    emit the events the firmware sends from `main()` (e.g. READY).
+    """
+    def __init__(self, fd, group='nrf_pytest', name='sim'):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.group = group
+        self.name = name
+        self.gid = 0
+
+        # Like the firmware: packets that don't fit in the other side's frame
+        # buffer are fragmented, and longer frames are rejected
+        self.fragments = FragmentLink(self._write)
+        self.framer = UARTFramer(self.fragments.handle_rx, self.fragments.max_frame_size)
+        self.established = False
+        self.halted = True
+
+        self.boot_handler = None
+        self.log_handler = None
+        self.evt_handlers = {}
+        self.cmd_handlers = {}
+
+        self._tx_lock = threading.Lock()
+        self._stop_flag = threading.Event()
+        (self._wakeup_r, self._wakeup_w) = os.pipe()
+
+    def __repr__(self):
+        return f'RPCPeer {self.name}'
+
+    def register_evt(self, opcode: int, handler):
+        self.evt_handlers[opcode] = handler
+
+    def register_cmd(self, opcode: int, handler):
+        self.cmd_handlers[opcode] = handler
+
+    def register_boot(self, handler):
+        self.boot_handler = handler
+
+    def log(self, line: str):
+        """Emulates a line of device (RTT) log."""
+        LOGGER.debug(f'[{self.name}] {line}')
+        if self.log_handler is not None:
+            self.log_handler(line + '\n')
+
+    def _write(self, frame: bytes):
+        with self._tx_lock:
+            view = memoryview(frame)
+            while view:
+                view = view[os.write(self.fd, view):]
+
+    def send(self, packet: RPCPacket):
+        self.fragments.send(packet.raw)
+
+    def make_packet(self, packet_type: RPCPacketType, opcode: int, data: bytes=b''):
+        return RPCPacket(packet_type, opcode,
+                         src=0, dst=0xFF,
+                         gid_src=self.gid, gid_dst=self.gid,
+                         payload=data)
+
+    def emit(self, opcode: int, data=None):
+        """Send an event, `data` is CBOR-encoded. Doesn't wait for the ACK."""
+        if self.halted:
+            return
+
+        self.send(self.make_packet(RPCPacketType.EVT, opcode, CBORPayload(data).encoded))
+
+    def reset(self):
+        """Reboot the simulated device: start the INIT handshake."""
+        self.framer.reset()
+        self.fragments.reset()
+        self.established = False
+        self.halted = False
+
+        version = b'\x00'
+        self.send(RPCPacket(RPCPacketType.INIT,
+                            0, 0, 0xFF, self.gid, self.gid,
+                            version + self.group.encode()))
+
+    def halt(self):
+        """Stop responding, like a halted or crashed CPU."""
+        self.halted = True
+
+    def handle(self, packet: RPCPacket):
+        if self.halted:
+            return
+
+        if packet.packet_type == RPCPacketType.INIT:
+            assert packet.payload == b'\x00' + self.group.encode()
+            self.established = True
+            if self.boot_handler is not None:
+                self.boot_handler(self)
+
+        elif packet.packet_type == RPCPacketType.EVT:
+            if packet.opcode in self.evt_handlers:
+                self.evt_handlers[packet.opcode](self, packet)
+            else:
+                LOGGER.warning(f'[{self.name}] unhandled event {packet}')
+
+            # The handler might have crashed the device
+            if not self.halted:
+                self.send(self.make_packet(RPCPacketType.ACK, packet.opcode))
+
+        elif packet.packet_type == RPCPacketType.CMD:
+            if packet.opcode in self.cmd_handlers:
+                rsp = self.cmd_handlers[packet.opcode](self, packet)
+                if not self.halted:
+                    self.send(self.make_packet(RPCPacketType.RSP, packet.opcode,
+                                               CBORPayload(rsp).encoded))
+            else:
+                LOGGER.warning(f'[{self.name}] unhandled command {packet}')
+
+        elif packet.packet_type == RPCPacketType.ACK:
+            # Events emitted by the peer don't wait for their ACK
+            pass
+
+        else:
+            LOGGER.error(f'[{self.name}] unhandled packet {packet}')
+
+    def run(self):
+        while not self._stop_flag.is_set():
+            (ready, _, _) = select.select([self.fd, self._wakeup_r], [], [])
+            if self.fd not in ready:
+                continue
+
+            try:
+                recv = os.read(self.fd, 4096)
+            except OSError:
+                # The host side of a pty has been closed
+                recv = b''
+
+            if recv == b'':
+                # Don't spin on a closed link
+                self._stop_flag.wait(0.01)
+                continue
+
+            for packet in self.framer.feed_packets(recv):
+                self.handle(packet)
+
+    def open(self):
+        self.start()
+
+    def close(self):
+        self._stop_flag.set()
+        os.write(self._wakeup_w, b'\x00')
+        self.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
+class LoopbackTransport(PacketTransport):
+    """Packet transport over a socketpair, connected to an in-process RPCPeer.
+
+    Skips the serial port entirely, e.g. to profile the RPC layers. Packets are
+    fragmented like on a UART.
+    """
+    def __init__(self, packet_handler=None):
+        self.packet_handler = packet_handler
+        self.fragments = FragmentLink(self._write)
+        self.framer = UARTFramer(self.fragments.handle_rx, self.fragments.max_frame_size)
+
+        (self._sock, self._remote) = socket.socketpair()
+        # Writes are handed off to a writer thread like on a real UART: the
+        # callers may hold the channel locks that the peer's ACKs and credits
+        # need, so they must never block on a full socket buffer.
+        self._tx_file = self._sock.makefile('wb', buffering=0)
+        self._writer = UARTWriter(self._tx_file, repr(self))
+        self._rx_thread = threading.Thread(target=self._run, daemon=True)
+
+    def __repr__(self):
+        return f'loopback {self._sock.fileno()}'
+
+    @property
+    def remote_fd(self):
+        """File descriptor to hand over to the RPCPeer."""
+        return self._remote.fileno()
+
+    def open(self):
+        self._writer.start()
+        self._rx_thread.start()
+
+    def close(self):
+        self._writer.close()
+        # Unblocks the RX thread
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._rx_thread.join()
+        self._tx_file.close()
+        self._sock.close()
+        self._remote.close()
+
+    def _write(self, frame: bytes):
+        self._writer.put(frame)
+
+    def clear_buffers(self):
+        # Same as UARTRPCChannel: the peer has been reset
+        self._writer.discard()
+        self.fragments.reset()
+
+    def flush(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        self.fragments.wait_idle(timeout)
+        self._writer.wait(timeout=max(0, deadline - time.monotonic()))
+
+    def send(self, data, timeout=15):
+        self.fragments.send(data)
+
+    def _run(self):
+        while True:
+            recv = self._sock.recv(4096)
+            if recv == b'':
+                break
+
+            self.handle_rx(recv)
+
+    def handle_rx(self, data: bytes):
+        for packet in self.framer.feed_packets(data):
+            self.packet_handler(packet)
+
+
+class SimulatedDevkit(Devkit):
+    """Devkit backed by an RPCPeer behind a pty instead of real hardware.
+
+    The host opens `port` like the serial port of a real DK.
+    """
+    def __init__(self, id, family, name, group='nrf_pytest'):
+        super().__init__(id, family, name)
+
+        (self._pty_main, self._pty_sub) = pty.openpty()
+        tty.setraw(self._pty_sub)
+        self.port = os.ttyname(self._pty_sub)
+
+        self.peer = RPCPeer(self._pty_main, group, name)
+
+    def __repr__(self):
+        return f'{self.name}: sim {self.segger_id} {self.port} '
+
+    @property
+    def has_logs(self):
+        # Emulated by the peer, no emulator needed
+        return True
+
+    def start_logging(self):
+        self.logs.clear()
+        self.peer.log_handler = self.log_handler
+
+    def stop_logging(self):
+        self.peer.log_handler = None
+
+    def open(self, open_emu=False):
+        LOGGER.debug(f'[{self.segger_id}] sim devkit open')
+        self.in_use = True
+        self.peer.open()
+
+    def close(self):
+        LOGGER.debug(f'[{self.segger_id}] sim devkit close')
+        self.in_use = False
+        self.peer.close()
+        os.close(self._pty_main)
+        os.close(self._pty_sub)
+
+    def reset(self):
+        self.peer.reset()
+
+    def halt(self):
+        self.peer.halt()
@@ -3,18 +3,152 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
 #
+import os
+import collections
 import serial
+import select
 import time
 import threading
 import logging
 from contextlib import contextmanager
 from targettest.uart_packet import UARTHeader
+from targettest.fragment import FragmentLink
 from targettest.rpc_packet import RPCPacket
 from targettest.abstract_transport import PacketTransport
 
 LOGGER = logging.getLogger(__name__)
 
 
+class UARTWriter(threading.Thread):
+    """Serializes all writes to a serial port.
+
+    Frames are queued by any thread and written by this one, so frames sent
+    concurrently (e.g. an ACK from the RX thread and an EVT from the test) never
+    interleave on the wire. Small frames that are queued back-to-back are merged
+    into a single write, larger ones are written from a memoryview without
+    being copied.
+    """
+    COALESCE_MAX_SIZE = 512
+
+    def __init__(self, serial_port, port_name=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port_name
+        self._serial = serial_port
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._stop_flag = False
+        self._error = None
+
+        # Sequence numbers of the last queued and last written frames
+        self._queued = 0
+        self._written = 0
+
+    def _raise_error(self):
+        # Report a failed write once, to the first sender to notice it
+        error = self._error
+        self._error = None
+        raise error
+
+    def put(self, data):
+        """Queue a frame. Returns its sequence number, to be used with `wait`."""
+        with self._cond:
+            if self._error is not None:
+                self._raise_error()
+
+            self._queue.append(data)
+            self._queued += 1
+            self._cond.notify_all()
+
+            return self._queued
+
+    def wait(self, seq=None, timeout=15):
+        """Block until frame `seq` (by default, every queued frame) is written."""
+        with self._cond:
+            if seq is None:
+                seq = self._queued
+
+            if not self._cond.wait_for(lambda: self._written >= seq or self._error is not None,
+                                       timeout):
+                LOGGER.error(f'Message not sent during required time: {timeout}')
+                raise TimeoutError
+
+            if self._error is not None:
+                self._raise_error()
+
+    def discard(self):
+        """Drop the frames that haven't been picked up for writing yet."""
+        with self._cond:
+            self._queue.clear()
+            self._written = self._queued
+            self._cond.notify_all()
+
+    def _coalesce(self, frames):
+        batch = bytearray()
+
+        for frame in frames:
+            if len(batch) + len(frame) <= self.COALESCE_MAX_SIZE:
+                batch += frame
+                continue
+
+            if batch:
+                yield batch
+                batch = bytearray()
+
+            if len(frame) > self.COALESCE_MAX_SIZE:
+                yield frame
+            else:
+                batch += frame
+
+        if batch:
+            yield batch
+
+    def _write(self, data):
+        view = memoryview(data)
+
+        while view:
+            byte_count = self._serial.write(view)
+            view = view[byte_count:]
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._stop_flag)
+
+                if not self._queue:
+                    # Only stop once everything has been written
+                    break
+
+                frames = self._queue
+                self._queue = collections.deque()
+                seq = self._queued
+
+            try:
+                for chunk in self._coalesce(frames):
+                    self._write(chunk)
+
+            except Exception as e:
+                LOGGER.error(f'TX [{self.port}] write failed: {e!r}')
+                with self._cond:
+                    self._error = e
+
+            with self._cond:
+                self._written = max(self._written, seq)
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stop_flag = True
+            self._cond.notify_all()
+
+        self.join()
+
+
+def default_rx_mode():
+    # Waiting on the port's file descriptor is only possible on POSIX systems
+    return 'event' if os.name == 'posix' else 'poll'
+
+
 class UARTChannel(threading.Thread):
     DEFAULT_TIMEOUT = 0.001
     DEFAULT_WRITE_TIMEOUT = 5
@@ -25,88 +159,271 @@ class UARTChannel(threading.Thread):
                  port=None,
                  baudrate=1000000,
                  rtscts=True,
-                 rx_handler=None):
+                 rx_handler=None,
+                 rx_mode=None,
+                 trace=None):
         # TODO: Maybe serial.threaded could be used
         threading.Thread.__init__(self, daemon=True)
         self.port = port
 
         self._stop_rx_flag = threading.Event() # Used to cleanly stop the RX thread
         self._rx_handler = rx_handler # Mandatory, called for each RX packet/unit
+        # Optional, called with ('TX' or 'RX', data) for everything on the wire
+        self.trace = trace
 
         self._max_recv_byte_count = self.MAX_RECV_BYTE_COUNT
 
+        # 'event': block on the port's fd until data arrives or the channel is closed
+        # 'poll': read with a short timeout in a loop
+        self.rx_mode = rx_mode if rx_mode is not None else default_rx_mode()
+        assert self.rx_mode in ('event', 'poll'), f'Invalid RX mode: {self.rx_mode}'
+
+        # RX loop statistics, to compare the RX modes
+        self.rx_wakeups = 0
+        self.rx_cpu_time = 0
+
+        if self.rx_mode == 'event':
+            # Reads never block, we only read what select() reported as available
+            timeout = 0
+            # Written to on close(), to wake up the RX thread immediately
+            (self._wakeup_r, self._wakeup_w) = os.pipe()
+        else:
+            timeout = UARTChannel.DEFAULT_TIMEOUT
+
         self._serial = serial.Serial(port=port, baudrate=baudrate, rtscts=rtscts,
-                                     timeout=UARTChannel.DEFAULT_TIMEOUT,
+                                     timeout=timeout,
                                      write_timeout=UARTChannel.DEFAULT_WRITE_TIMEOUT)
 
+        self._writer = UARTWriter(self._serial, port)
+
     def clear_buffers(self):
         self._serial.reset_input_buffer()
+        self._writer.discard()
         self._serial.reset_output_buffer()
 
-    def send(self, data, timeout=15):
-        data = bytearray(data)
+    def send(self, data, timeout=15, flush=False):
+        # `data` is queued as-is, it must not be modified afterwards
+        LOGGER.debug(f'TX [{self.port}] {data.hex(" ")}')
+        if self.trace is not None:
+            self.trace('TX', data)
 
-        byte_count = 0
-        start_time = time.monotonic()
+        seq = self._writer.put(data)
 
-        LOGGER.debug(f'TX [{self.port}] {data.hex(" ")}')
-        while data:
-            data = data[byte_count:]
+        if flush:
+            self._writer.wait(seq, timeout)
 
-            byte_count += self._serial.write(data)
+        return len(data)
 
-            if time.monotonic() - start_time > timeout:
-                LOGGER.error(f'Message not sent during required time: {timeout}')
-                raise TimeoutError
+    def flush(self, timeout=15):
+        """Block until every frame queued so far has been written."""
+        self._writer.wait(timeout=timeout)
+
+    def _read_poll(self):
+        recv = self._serial.read(self.MAX_RECV_BYTE_COUNT)
+
+        # Yield to other threads
+        if recv == b'':
+            time.sleep(0.0001)
+
+        return recv
+
+    def _read_event(self):
+        (ready, _, _) = select.select([self._serial.fileno(), self._wakeup_r], [], [])
 
-        return byte_count
+        if self._serial.fileno() not in ready:
+            # Woken up by close()
+            return b''
+
+        # Drain everything the driver has buffered in one go. Still try to read
+        # one byte if it reports nothing, so a disconnected port raises instead
+        # of spinning.
+        return self._serial.read(self._serial.in_waiting or 1)
 
     def run(self):
-        LOGGER.debug(f'Start RX [{self.port}]')
+        LOGGER.debug(f'Start RX [{self.port}] ({self.rx_mode} mode)')
         self._stop_rx_flag.clear()
 
-        while not self._stop_rx_flag.isSet():
-            recv = self._serial.read(self.MAX_RECV_BYTE_COUNT)
+        read = self._read_event if self.rx_mode == 'event' else self._read_poll
+        start_cpu_time = time.thread_time()
 
-            # Yield to other threads
-            if recv == b'':
-                time.sleep(0.0001)
-                continue
+        try:
+            while not self._stop_rx_flag.is_set():
+                recv = read()
+                self.rx_wakeups += 1
+
+                if recv == b'':
+                    continue
 
-            LOGGER.debug(f'RX [{self.port}] {recv.hex(" ")}')
+                LOGGER.debug(f'RX [{self.port}] {recv.hex(" ")}')
+                if self.trace is not None:
+                    self.trace('RX', recv)
 
-            self._rx_handler(recv)
+                self._rx_handler(recv)
+
+        finally:
+            self.rx_cpu_time = time.thread_time() - start_cpu_time
+            LOGGER.debug(f'Stop RX [{self.port}]: {self.rx_wakeups} wakeups, '
+                         f'{self.rx_cpu_time:.3f}s CPU time')
 
     def open(self):
+        self._writer.start()
         self.start()
 
     def close(self):
         self._stop_rx_flag.set()
+
+        if self.rx_mode == 'event':
+            os.write(self._wakeup_w, b'\x00')
+
         self.join()
+        self._writer.close()
         self._serial.close()
 
+        if self.rx_mode == 'event':
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+
+
+class UARTFramer():
+    """Incremental UART frame decoder.
+
+    Received chunks are appended to a single buffer and consumed through a read
+    offset. Every complete frame in the buffer is extracted in one pass, and the
+    consumed bytes are only dropped once in a while (when they make up most of
+    the buffer), so decoding stays linear in the amount of received data.
+
+    Frames with an invalid CRC are dropped, and decoding resumes from the next
+    magic value after the bad header, so a corrupted length field doesn't
+    swallow the frames that follow. Headers with a length above `max_length`
+    are rejected right away, without waiting for that much data.
 
-class UARTDecodingState():
-    def __init__(self):
+    Frames carrying a fragment are handed over to `fragment_handler` (see
+    fragment.py).
+    """
+    _magic = UARTHeader._header
+
+    def __init__(self, fragment_handler=None, max_length=UARTHeader.MAX_LENGTH):
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.fragment_handler = fragment_handler
+        self.max_length = max_length
         self.reset()
 
     def reset(self):
-        self.rx_buf = b''
-        self.header = None
+        self.rx_buf = bytearray()
+        self.offset = 0
 
     def __repr__(self):
-        return f'{self.header} buf {self.rx_buf.hex(" ")}'
+        return f'offset {self.offset} buf {self.rx_buf[self.offset:].hex(" ")}'
+
+    def _compact(self):
+        if self.offset == len(self.rx_buf):
+            self.rx_buf.clear()
+            self.offset = 0
+        elif self.offset > len(self.rx_buf) // 2:
+            del self.rx_buf[:self.offset]
+            self.offset = 0
+
+    def _spans(self, data: bytes):
+        # Yields the (start, end, fragment) of the complete frames in the
+        # buffer. The buffer isn't resized until the generator is exhausted.
+        buf = self.rx_buf
+        buf += data
+
+        while len(buf) - self.offset >= UARTHeader._size:
+            start = buf.find(self._magic, self.offset)
+            if start < 0:
+                # Keep what could be the beginning of the next magic
+                self.offset = max(self.offset, len(buf) - len(self._magic) + 1)
+                break
+
+            if start != self.offset:
+                LOGGER.debug(f'resync: skipped {start - self.offset} bytes')
+                self.offset = start
+
+            if len(buf) - start < UARTHeader._size:
+                break
+
+            header = UARTHeader.unpack_from(buf, start)
+            length = header.length & UARTHeader.MAX_LENGTH
+            if length > self.max_length:
+                self.length_errors += 1
+                LOGGER.warning(f'invalid frame length {length}, dropping frame '
+                               f'({self.length_errors} errors)')
+                self.offset = start + 1
+                continue
+
+            end = start + header._size + length
+            if end > len(buf):
+                # Wait until the whole frame has been received
+                break
+
+            with memoryview(buf) as view:
+                crc = UARTHeader.calc_crc(view[start + header._size:end], header.length)
+
+            if crc != header.crc:
+                self.crc_errors += 1
+                LOGGER.warning(f'CRC mismatch, dropping frame ({self.crc_errors} errors)')
+                self.offset = start + 1
+                continue
+
+            self.offset = end
+            yield (start, end, bool(header.length & UARTHeader.FRAGMENT_FLAG))
+
+        self._compact()
+
+    def feed(self, data: bytes):
+        """Append data to the buffer and return the list of complete frames.
+
+        Frames are returned as `bytes`, including the UART header.
+        """
+        return [bytes(self.rx_buf[start:end]) for (start, end, _) in self._spans(data)]
+
+    def feed_packets(self, data: bytes):
+        """Same as feed(), but returns the frames decoded as RPCPackets.
+
+        Packets are decoded straight from the buffer, only their payload is
+        copied. Fragments are passed to `fragment_handler`, which returns the
+        body of the reassembled packet once complete.
+        """
+        packets = []
+
+        for (start, end, fragment) in self._spans(data):
+            if not fragment:
+                packets.append(RPCPacket.unpack_from(self.rx_buf, start))
+                continue
+
+            if self.fragment_handler is None:
+                LOGGER.warning('dropping fragment, fragmentation is not supported')
+                continue
+
+            body = self.fragment_handler(bytes(self.rx_buf[start + UARTHeader._size:end]))
+            if body is not None:
+                packets.append(RPCPacket.unpack_body(body))
+
+        return packets
 
 
 class UARTRPCChannel(PacketTransport):
+    """Packet transport over a serial port.
+
+    Packets that don't fit in the device's frame buffer (`max_frame_size`) are
+    fragmented, see fragment.py. The device does the same, so longer frames
+    are rejected.
+    """
     def __init__(self,
                  port,
                  baudrate=1000000,
                  rtscts=True,
-                 packet_handler=None):
+                 packet_handler=None,
+                 rx_mode=None,
+                 max_frame_size=2048,
+                 trace=None):
 
-        self.uart = UARTChannel(port, baudrate, rtscts, rx_handler=self.handle_rx)
-        self.state = UARTDecodingState()
+        self.uart = UARTChannel(port, baudrate, rtscts, rx_handler=self.handle_rx,
+                                rx_mode=rx_mode, trace=trace)
+        self.fragments = FragmentLink(self.uart.send, max_frame_size)
+        self.framer = UARTFramer(self.fragments.handle_rx, max_frame_size)
 
         LOGGER.debug(f'UART packet channel init: {port}')
 
@@ -119,37 +436,19 @@ class UARTRPCChannel(PacketTransport):
     def close(self):
         self.uart.close()
 
+    def clear_buffers(self):
+        # The device has been reset, it won't give back credits for nor
+        # complete the fragmented messages in progress
+        self.fragments.reset()
+
     def send(self, data, timeout=15):
-        self.uart.send(data, timeout)
+        self.fragments.send(data)
 
-    def handle_rx(self, data: bytes):
-        # Prepend the (just received) data with the remains of the last RX
-        data = self.state.rx_buf + data
-        # Save the current data in case decoding is not complete
-        self.state.rx_buf = data
-
-        if len(data) >= UARTHeader._size:
-            if self.state.header is None:
-                # Attempt to decode the header
-                self.state.header = UARTHeader.unpack(data)
-
-            if self.state.header is None:
-                # Header failed to decode, eat one byte and try again
-                self.state.rx_buf = self.state.rx_buf[1:]
-                if len(data) >= UARTHeader._size:
-                    self.handle_rx(b'')
-
-        if self.state.header is not None:
-            # Header has been decoded
-            # Try to decode the packet
-            if len(data[self.state.header._size:]) >= self.state.header.length:
-                packet = RPCPacket.unpack(data)
-                self.packet_handler(packet)
-
-                # Consume the data in the RX buffer
-                data = data[self.state.header._size + self.state.header.length:]
-                self.state.reset()
-
-                if len(data) > 0:
-                    self.handle_rx(data)
+    def flush(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        self.fragments.wait_idle(timeout)
+        self.uart.flush(max(0, deadline - time.monotonic()))
 
+    def handle_rx(self, data: bytes):
+        for packet in self.framer.feed_packets(data):
+            self.packet_handler(packet)
@@ -8,11 +8,40 @@ import logging
 
 LOGGER = logging.getLogger(__name__)
 
+# CRC-8-CCITT (polynomial 0x07), same as Zephyr's crc8_ccitt()
+CRC8_CCITT_INITIAL_VALUE = 0xFF
+
+
+def _make_crc8_table(poly=0x07):
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+        table[i] = crc
+    return bytes(table)
+
+_CRC8_TABLE = _make_crc8_table()
+
+
+def crc8_ccitt(data, crc=CRC8_CCITT_INITIAL_VALUE):
+    table = _CRC8_TABLE
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
 
 class UARTHeader():
+    __slots__ = ('length', 'crc', 'raw')
+
+    # Set in the length field of the frames carrying a fragment (see fragment.py)
+    FRAGMENT_FLAG = 0x8000
+    MAX_LENGTH = 0x7FFF
+
     _header = b'UART'
     _format = '<4sHB'
     _size = struct.calcsize(_format)
+    _struct = struct.Struct(_format)
 
     def __init__(self, length: int, crc: int):
         self.length = length
@@ -36,14 +65,43 @@ class UARTHeader():
         return None
 
     @classmethod
-    def calc_crc(cls, packet: bytes):
-        return 0
+    def unpack_from(cls, buf, offset=0):
+        # Decode a header located at `offset`, without copying the buffer.
+        # The caller is responsible for checking the magic value.
+        (_, length, crc) = cls._struct.unpack_from(buf, offset)
+        return cls(length, crc)
+
+    @classmethod
+    def calc_crc(cls, packet: bytes, length=None):
+        # The CRC covers the length field (by default, the payload length) and
+        # the payload
+        if length is None:
+            length = len(packet)
+        return crc8_ccitt(packet, crc8_ccitt(struct.pack('<H', length)))
+
+    @classmethod
+    def frame(cls, payload: bytes, fragment=False):
+        """Whole UART frame for `payload`.
+
+        Payloads longer than MAX_LENGTH get a blank header: they can only be
+        sent fragmented, by the transport.
+        """
+        length = len(payload)
+        if length > cls.MAX_LENGTH:
+            return cls._struct.pack(cls._header, 0, 0) + payload
+
+        if fragment:
+            length |= cls.FRAGMENT_FLAG
+
+        return cls._struct.pack(cls._header, length, cls.calc_crc(payload, length)) + payload
 
     def __repr__(self):
         return f'len {self.length} crc {self.crc} raw {self.raw}'
 
 
 class UARTPacket():
+    __slots__ = ('length', 'header', 'payload', 'raw')
+
     def __init__(self, payload=b''):
         self.length = len(payload)
         self.header = UARTHeader(self.length, UARTHeader.calc_crc(payload))
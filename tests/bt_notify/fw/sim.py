@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2022 Nordic Semiconductor ASA
+#
+# SPDX-License-Identifier: LicenseRef-Nordic-5-Clause
+#
+# Simulated version of the test firmware, used with `pytest --sim`.
+# Mirrors the behavior of src/main.c and src/rpc_handler.c.
+#
+import enum
+from targettest.cbor import CBORPayload
+
+
+# Same as test_rpc_opcodes.h
+class RPCOpcodes(enum.IntEnum):
+    RPC_EVENT_READY = 0x01
+    RPC_EVENT_BT_CONNECTED = enum.auto()
+    RPC_EVENT_BT_DISCONNECTED = enum.auto()
+    RPC_EVENT_BT_SCAN_REPORT = enum.auto()
+    RPC_EVENT_DEMO_NESTED_LIST = enum.auto()
+
+    RPC_ASYNC_BT_ADVERTISE = enum.auto()
+    RPC_ASYNC_BT_SCAN = enum.auto()
+    RPC_ASYNC_BT_SCAN_STOP = enum.auto()
+    RPC_ASYNC_BT_CONNECT = enum.auto()
+    RPC_ASYNC_BT_DISCONNECT = enum.auto()
+
+    RPC_ASYNC_K_OOPS = enum.auto()
+
+BT_ADDR_LE_RANDOM = 1
+BT_GAP_ADV_TYPE_ADV_IND = 0
+AD_DATA_LEN = 3
+RSSI = -40
+
+
+class SimulatedRadio():
+    """Shared 'air' between the simulated devices."""
+    def __init__(self):
+        self.nodes = []
+
+    def advertisers(self):
+        return [node for node in self.nodes if node.advertising]
+
+    def find(self, addr):
+        for node in self.nodes:
+            if node.addr == addr:
+                return node
+        return None
+
+
+class SimulatedFirmware():
+    def __init__(self, radio, devkit):
+        self.radio = radio
+        self.peer = devkit.peer
+
+        # Static random address, derived from the device ID
+        self.addr = [BT_ADDR_LE_RANDOM,
+                     bytes([0xC0, 0, 0, 0, 0, devkit.segger_id & 0xFF])]
+
+        self.advertising = False
+        self.rssi_threshold = None
+
+        self.peer.register_boot(self.main)
+        self.peer.register_evt(RPCOpcodes.RPC_ASYNC_BT_ADVERTISE, self.handler_advertise)
+        self.peer.register_evt(RPCOpcodes.RPC_ASYNC_BT_SCAN, self.handler_scan)
+        self.peer.register_evt(RPCOpcodes.RPC_ASYNC_BT_SCAN_STOP, self.handler_scan_stop)
+        self.peer.register_evt(RPCOpcodes.RPC_ASYNC_BT_CONNECT, self.handler_connect)
+        self.peer.register_evt(RPCOpcodes.RPC_ASYNC_K_OOPS, self.handler_k_oops)
+
+        radio.nodes.append(self)
+
+    def main(self, peer):
+        # State is lost on reset
+        self.advertising = False
+        self.rssi_threshold = None
+
+        peer.log('RPC testing app started [APP Core].')
+        peer.log('bt enabled')
+        peer.emit(RPCOpcodes.RPC_EVENT_READY)
+        peer.log('evt_ready sent')
+
+    def device_found(self, node):
+        if self.rssi_threshold is None or RSSI <= self.rssi_threshold:
+            return
+
+        self.peer.log(f'[DEVICE]: {node.addr}, AD evt type {BT_GAP_ADV_TYPE_ADV_IND}, '
+                      f'AD data len {AD_DATA_LEN}, RSSI {RSSI}')
+        self.peer.emit(RPCOpcodes.RPC_EVENT_BT_SCAN_REPORT,
+                       [node.addr, BT_GAP_ADV_TYPE_ADV_IND, AD_DATA_LEN, RSSI])
+
+    def handler_advertise(self, peer, packet):
+        self.advertising = True
+        peer.log('bt_le_adv_start: 0')
+
+        peer.emit(RPCOpcodes.RPC_EVENT_DEMO_NESTED_LIST,
+                  [[1337, -1234], [b'hello\x00', -1, b'from the other\x00', 2, 3, b'side\x00']])
+        peer.log('Sent demo event')
+
+        for node in self.radio.nodes:
+            if node is not self:
+                node.device_found(self)
+
+    def handler_scan(self, peer, packet):
+        self.rssi_threshold = CBORPayload.read(packet.payload).objects[0]
+        peer.log(f'RSSI threshold {self.rssi_threshold}')
+        peer.log('bt_le_scan_start: 0')
+
+        for node in self.radio.advertisers():
+            if node is not self:
+                self.device_found(node)
+
+    def handler_scan_stop(self, peer, packet):
+        self.rssi_threshold = None
+        peer.log('bt_le_scan_stop: 0')
+
+    def handler_connect(self, peer, packet):
+        (addr, _) = CBORPayload.read(packet.payload).objects[0]
+        peer.log('bt_conn_le_create (0)')
+
+        node = self.radio.find(addr)
+        if node is None or not node.advertising:
+            return
+
+        node.advertising = False
+        for (local, remote) in ((self, node), (node, self)):
+            local.peer.log('connected')
+            local.peer.emit(RPCOpcodes.RPC_EVENT_BT_CONNECTED, [remote.addr, 0])
+
+    def handler_k_oops(self, peer, packet):
+        peer.log('Triggering panic')
+        peer.halt()
+
+
+def setup(devices: dict):
+    radio = SimulatedRadio()
+
+    for devkit in devices.values():
+        SimulatedFirmware(radio, devkit)
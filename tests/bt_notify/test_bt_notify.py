@@ -9,6 +9,7 @@ import time
 import enum
 import logging
 from targettest.cbor import CBORPayload
+from targettest.codec import CodecRegistry, record
 
 LOGGER = logging.getLogger(__name__)
 
@@ -27,6 +28,20 @@ class RPCEvents(enum.IntEnum):
     BT_DISCONNECT = enum.auto()
     K_OOPS = enum.auto()
 
+# Payload layouts, as encoded/decoded in rpc_handler.c
+BtAddr = record('BtAddr', ('type', int), ('val', bytes))
+ScanReport = record('ScanReport', ('addr', BtAddr), ('adv_type', int), ('ad_len', int), ('rssi', int))
+Connected = record('Connected', ('addr', BtAddr), ('err', int))
+ConnParams = record('ConnParams', ('options', int), ('interval', int), ('window', int), ('timeout', int))
+Connect = record('Connect', ('addr', BtAddr), ('params', ConnParams))
+
+# Picked up by the testdevices fixture
+CODECS = CodecRegistry()
+CODECS.register(RPCEvents.BT_SCAN_REPORT, ScanReport)
+CODECS.register(RPCEvents.BT_CONNECTED, Connected)
+CODECS.register(RPCEvents.BT_SCAN, int, memoize=True)
+CODECS.register(RPCEvents.BT_CONNECT, Connect)
+
 def configure_advertiser(rpcdevice):
     # configure & start advertiser with static name
     LOGGER.info("Configure adv")
@@ -83,6 +98,16 @@ class TestBluetooth():
 
         LOGGER.info(f'evt: {payload}')
 
+        # Both devices logged what they did. The logs are read over RTT, so
+        # not available with --no-emu.
+        if not (advertiser.dk.has_logs and scanner.dk.has_logs):
+            LOGGER.info('no device logs, skipping the log checks')
+            return
+
+        advertiser.dk.wait_for_log(r'bt_le_adv_start: 0')
+        found = scanner.dk.wait_for_log(r'\[DEVICE\]: .* RSSI (-?\d+)')
+        LOGGER.info(f'scanned with RSSI {found.match[1]}')
+
     def test_conn(self, testdevices):
         peripheral = testdevices['dut'].rpc
         central = testdevices['tester'].rpc
@@ -100,9 +125,9 @@ class TestBluetooth():
         assert event is not None
         assert event.opcode == RPCEvents.BT_SCAN_REPORT
 
-        # Decode payload and extract the address
+        # Extract the address from the decoded payload
         LOGGER.info(f'scan report: {payload}')
-        addr = payload[0]
+        addr = payload.addr
 
         # Stop scanner and create a connection
         LOGGER.info("Start conn")